@@ -2,9 +2,38 @@
 
 __author__ = 'Jorge'
 
+import codecs
+import io
+import json
+import mmap
+import os
+import re
+import sre_constants
+import sre_parse
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from itertools import chain
+from multiprocessing import cpu_count
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 __all__ = [
     'Caret',
-    'StrList'
+    'InputCoalescer',
+    'LineRope',
+    'MappedLines',
+    'SelectionView',
+    'StrList',
+    'TextChanges',
+    'TextSnapshot',
+    'Viewport'
 ]
 
 
@@ -58,9 +87,13 @@ class Caret(object):
     MODINSERTTAB     = 12
     MODDELSELECTION  = 13
     MODMOVSELECTION = 14
+    MODINDENTLINES   = 15
+    MODDEDENTLINES   = 16
 
     # utility text operations
     UTLGETSELECTION = 1
+    UTLFINDNEXT     = 2
+    UTLREPLACEALL   = 3
     
     # advanced text operations
     ADVSAVETOFILE   = 1
@@ -68,6 +101,11 @@ class Caret(object):
     ADVOPENFROMFILE = 3
     ADVOPENFROMMEM  = 4
 
+    # operation kinds, as used by StrList.apply_ops
+    MOVOPERATION = 1
+    SELOPERATION = 2
+    MODOPERATION = 3
+
     # option flags
     AUTOINDENT = 1
     DEDENTONBKSPC = 2
@@ -121,7 +159,7 @@ class Caret(object):
             if self._line < self.page_pos[1]:
                 self._page_pos[1] = self._line
             else:
-                self._page_pos[1] = self._line - self.page_size[1]
+                self._page_pos[1] = self._line - self.page_size[1] + 1
 
     @property
     def column(self):
@@ -141,7 +179,7 @@ class Caret(object):
             if self._column < self.page_pos[0]:
                 self._page_pos[0] = self._column
             else:
-                self._page_pos[0] = self._column - self.page_size[0]
+                self._page_pos[0] = self._column - self.page_size[0] + 1
 
     @property
     def page_size(self):
@@ -197,28 +235,1758 @@ class Caret(object):
 
     def page_scroll(self, hscroll, vscroll):
         """Sets the page position relative to its current location."""
-        self.page_pos[0] = max(0, self.page_pos[0] + hscroll)
-        self.page_pos[1] = max(0, self.page_pos[1] + vscroll)
+        self._page_pos[0] = max(0, self._page_pos[0] + hscroll)
+        self._page_pos[1] = max(0, self._page_pos[1] + vscroll)
+
+
+# Size of the chunks read by StrList.load.
+_IO_CHUNK_SIZE = 1 << 16
+
+# Size of the blocks scanned for line starts by MappedLines.
+_MMAP_SCAN_SIZE = 1 << 20
+
+# Array type code able to hold file offsets beyond 4GB.
+_OFFSET_TYPECODE = 'L' if array('L').itemsize >= 8 else 'd'
+
+# Number of lines scanned by each task of a parallel search.
+_PARALLEL_CHUNK_SIZE = 20000
+
+# Trigrams found in more than one line out of this ratio (and in more
+# than _TRIGRAM_COMMON_MIN lines) are not indexed.
+_TRIGRAM_COMMON_RATIO = 8
+_TRIGRAM_COMMON_MIN = 64
+
+# Byte order marks and the encodings they identify, longest first.
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def _detect_encoding(sample):
+    """Guesses the encoding of a file from its first bytes."""
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+    return 'utf-8'
 
 
-class StrList(object):
+def _decode_lines(stream, chunk, encoding):
+    """Reads and decodes a binary stream chunk by chunk, starting with an
+    already read chunk, and splits it into lines.
+
+    Returns the list of lines and the line terminator found in the text
+    (u'\\n', u'\\r\\n' or None if the text has a single line)."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    lines = []
+    pending = []
+    newline = None
+    while True:
+        final = not chunk
+        text = decoder.decode(chunk, final)
+        if u'\n' in text:
+            parts = text.split(u'\n')
+            parts[0] = u''.join(pending) + parts[0]
+            pending = [parts.pop()]
+            if newline is None:
+                newline = u'\r\n' if parts[0].endswith(u'\r') else u'\n'
+            if newline == u'\r\n':
+                parts = [part[:-1] if part.endswith(u'\r') else part for part in parts]
+            lines.extend(parts)
+        elif text:
+            pending.append(text)
+        if final:
+            break
+        chunk = stream.read(_IO_CHUNK_SIZE)
+
+    lines.append(u''.join(pending))
+    return lines, newline
+
+
+def _terminated_lines(lines, newline):
+    """Yields the lines followed by 'newline', but the last one."""
+    last = len(lines) - 1
+    for index, line in enumerate(lines):
+        yield line + newline if index < last else line
+
+
+def _save_lines(lines, target, encoding, newline):
+    """Encodes and writes lines to a file name or a binary file object, in
+    chunks of about _IO_CHUNK_SIZE characters."""
+    if isinstance(target, basestring):
+        with io.open(target, 'wb') as stream:
+            return _save_lines(lines, stream, encoding, newline)
+
+    encoder = codecs.getincrementalencoder(encoding)()
+    chunk = []
+    size = 0
+    for line in _terminated_lines(lines, newline):
+        chunk.append(line)
+        size += len(line)
+        if size >= _IO_CHUNK_SIZE:
+            target.write(encoder.encode(u''.join(chunk)))
+            chunk = []
+            size = 0
+    target.write(encoder.encode(u''.join(chunk), True))
+    target.flush()
+
+
+def _stream_start(stream):
+    """Returns the position of a binary file object, or None if it can not
+    seek. Python 2 file objects have no seekable() method."""
+    try:
+        if getattr(stream, 'seekable', lambda: True)():
+            return stream.tell()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+# Maximum number of lines held by a single leaf of a LineRope.
+_ROPE_LEAF_SIZE = 128
+
+
+class _RopeLeaf(object):
+
+    """A chunk of consecutive lines at the bottom of a LineRope."""
+
+    __slots__ = ('items', 'size')
+
+    height = 0
+
+    def __init__(self, items):
+        self.items = items
+        self.size = len(items)
+
+
+class _RopeNode(object):
+
+    """An inner node of a LineRope, joining two subtrees."""
+
+    __slots__ = ('left', 'right', 'size', 'height')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.size = left.size + right.size
+        self.height = max(left.height, right.height) + 1
+
+
+def _rope_node(left, right):
+    """Joins two subtrees whose heights differ by at most two, rotating
+    them back into balance when needed."""
+    if left.height > right.height + 1:
+        if left.left.height >= left.right.height:
+            return _RopeNode(left.left, _RopeNode(left.right, right))
+        mid = left.right
+        return _RopeNode(_RopeNode(left.left, mid.left), _RopeNode(mid.right, right))
+
+    if right.height > left.height + 1:
+        if right.right.height >= right.left.height:
+            return _RopeNode(_RopeNode(left, right.left), right.right)
+        mid = right.left
+        return _RopeNode(_RopeNode(left, mid.left), _RopeNode(mid.right, right.right))
+
+    return _RopeNode(left, right)
+
+
+def _rope_join(left, right):
+    """Concatenates two ropes (either may be None) in O(log n)."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.height == right.height == 0 and left.size + right.size <= _ROPE_LEAF_SIZE:
+        return _RopeLeaf(left.items + right.items)
+
+    if left.height > right.height + 1:
+        return _rope_node(left.left, _rope_join(left.right, right))
+    if right.height > left.height + 1:
+        return _rope_node(_rope_join(left, right.left), right.right)
+
+    return _RopeNode(left, right)
+
+
+def _rope_split(node, index):
+    """Splits a rope in two, the first one holding 'index' lines."""
+    if node is None:
+        return None, None
+    if index <= 0:
+        return None, node
+    if index >= node.size:
+        return node, None
+
+    if node.height == 0:
+        return _RopeLeaf(node.items[:index]), _RopeLeaf(node.items[index:])
+
+    lsize = node.left.size
+    if index < lsize:
+        left, right = _rope_split(node.left, index)
+        return left, _rope_join(right, node.right)
+    elif index > lsize:
+        left, right = _rope_split(node.right, index - lsize)
+        return _rope_join(node.left, left), right
+    return node.left, node.right
+
+
+def _rope_build(items):
+    """Builds a balanced rope out of a sequence of lines in O(n)."""
+    items = tuple(items)
+    if not items:
+        return None
+
+    leaves = [
+        _RopeLeaf(items[i: i + _ROPE_LEAF_SIZE])
+        for i in range(0, len(items), _ROPE_LEAF_SIZE)
+    ]
+
+    def build(lo, hi):
+        if hi - lo == 1:
+            return leaves[lo]
+        mid = (lo + hi) // 2
+        return _RopeNode(build(lo, mid), build(mid, hi))
+
+    return build(0, len(leaves))
+
+
+def _rope_replace(node, index, value):
+    """Returns a copy of the rope with the line at 'index' replaced.
+
+    Only the path from the root to the leaf is copied."""
+    if node.height == 0:
+        items = list(node.items)
+        items[index] = value
+        return _RopeLeaf(tuple(items))
+
+    lsize = node.left.size
+    if index < lsize:
+        return _RopeNode(_rope_replace(node.left, index, value), node.right)
+    return _RopeNode(node.left, _rope_replace(node.right, index - lsize, value))
+
+
+def _rope_leaves(node):
+    """Yields the leaves of a rope from left to right."""
+    stack = [node] if node is not None else []
+    while stack:
+        node = stack.pop()
+        if node.height == 0:
+            yield node
+        else:
+            stack.append(node.right)
+            stack.append(node.left)
+
+
+def _rope_collect(node, start, stop, out):
+    """Appends the lines in the [start, stop) range of a rope to 'out'."""
+    if node.height == 0:
+        out.extend(node.items[start: stop])
+        return
+
+    lsize = node.left.size
+    if start < lsize:
+        _rope_collect(node.left, start, min(stop, lsize), out)
+    if stop > lsize:
+        _rope_collect(node.right, max(0, start - lsize), stop - lsize, out)
+
+
+class LineRope(object):
+
+    """A list-like sequence of lines stored as a balanced tree of chunks.
+
+    LineRope can be used as the storage of a StrList object holding very
+    large texts: reading, replacing, inserting and deleting lines cost
+    O(log n), and replacing a range of lines with another sequence costs
+    O(log n + k), where k is the number of lines inserted.
+    """
+
+    __slots__ = ('_root',)
+
+    def __init__(self, lines=()):
+        self._root = _rope_build(lines)
+
+    def __len__(self):
+        return self._root.size if self._root is not None else 0
+
+    def __iter__(self):
+        for leaf in _rope_leaves(self._root):
+            for item in leaf.items:
+                yield item
+
+    def __contains__(self, item):
+        for leaf in _rope_leaves(self._root):
+            if item in leaf.items:
+                return True
+        return False
+
+    def __repr__(self):
+        return 'LineRope({!r})'.format(list(self))
+
+    def _index(self, key):
+        size = len(self)
+        if key < 0:
+            key += size
+        if not 0 <= key < size:
+            raise IndexError("LineRope index out of range.")
+        return key
+
+    def _range(self, key):
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("LineRope does not support extended slices.")
+        return start, max(start, stop)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = self._range(key)
+            lines = []
+            if start < stop:
+                _rope_collect(self._root, start, stop, lines)
+            return lines
+
+        node = self._root
+        index = self._index(key)
+        while node.height:
+            lsize = node.left.size
+            if index < lsize:
+                node = node.left
+            else:
+                index -= lsize
+                node = node.right
+        return node.items[index]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop = self._range(key)
+            head, tail = _rope_split(self._root, stop)
+            head, _ = _rope_split(head, start)
+            self._root = _rope_join(_rope_join(head, _rope_build(value)), tail)
+        else:
+            self._root = _rope_replace(self._root, self._index(key), value)
+
+    def __delitem__(self, key):
+        if not isinstance(key, slice):
+            key = self._index(key)
+            key = slice(key, key + 1)
+        self[key] = ()
+
+    def insert(self, index, value):
+        """Inserts a line before 'index'."""
+        index = max(0, min(len(self), index if index >= 0 else index + len(self)))
+        self[index: index] = (value,)
+
+    def copy(self):
+        """Returns a copy of the sequence in O(1).
+
+        The chunks of a LineRope are never modified, only replaced, so
+        the copy shares all of them with the original."""
+        rope = LineRope()
+        rope._root = self._root
+        return rope
+
+    def append(self, value):
+        """Appends a line at the end of the sequence."""
+        self._root = _rope_join(self._root, _RopeLeaf((value,)))
+
+    def extend(self, values):
+        """Appends a sequence of lines at the end of the sequence."""
+        self._root = _rope_join(self._root, _rope_build(values))
+
+
+class _GapBuffer(object):
+
+    """A mutable unicode string with a movable gap.
+
+    Inserting or deleting characters at the gap costs O(1). Moving the gap
+    costs O(d), d being the distance it travels, and is done with array
+    slice copies instead of new string allocations.
+    """
+
+    __slots__ = ('_chars', '_start', '_end')
+
+    def __init__(self, text=u'', gap=64):
+        self._chars = array('u', text)
+        self._start = len(self._chars)
+        self._chars.extend(array('u', u' ' * gap))
+        self._end = len(self._chars)
+
+    def __len__(self):
+        return len(self._chars) - (self._end - self._start)
+
+    def text(self):
+        """Returns the contents of the buffer as a unicode string."""
+        return self._chars[:self._start].tounicode() + self._chars[self._end:].tounicode()
+
+    def slice(self, start, stop):
+        """Returns the characters in the [start, stop) range."""
+        chars, gap, end = self._chars, self._start, self._end
+        size = len(self)
+        start = min(start, size)
+        stop = max(start, min(stop, size))
+        if stop <= gap:
+            return chars[start: stop].tounicode()
+        if start >= gap:
+            return chars[start + end - gap: stop + end - gap].tounicode()
+        return chars[start: gap].tounicode() + chars[end: end + stop - gap].tounicode()
+
+    def leading(self, chars):
+        """Returns the number of leading characters found in 'chars'."""
+        data, start, end = self._chars, self._start, self._end
+        size = len(self)
+        count = 0
+        while count < size:
+            if data[count if count < start else count + end - start] not in chars:
+                break
+            count += 1
+        return count
+
+    def _move_gap(self, pos):
+        chars, start, end = self._chars, self._start, self._end
+        if pos < start:
+            count = start - pos
+            chars[end - count: end] = chars[pos: start]
+            self._start, self._end = pos, end - count
+        elif pos > start:
+            count = pos - start
+            chars[start: pos] = chars[end: end + count]
+            self._start, self._end = pos, end + count
+
+    def replace(self, start, stop, text):
+        """Replaces the characters in the [start, stop) range with 'text'."""
+        size = len(self)
+        start = min(start, size)
+        stop = max(start, min(stop, size))
+        self._move_gap(start)
+        self._end += stop - start
+
+        count = len(text)
+        if count:
+            if count > self._end - self._start:
+                grow = max(count, len(self._chars) // 2, 64)
+                self._chars[self._start: self._start] = array('u', u' ' * grow)
+                self._end += grow
+            self._chars[self._start: self._start + count] = array('u', text)
+            self._start += count
+
+
+class MappedLines(object):
+
+    """A read-only, list-like sequence of the lines of a memory-mapped file.
+
+    Opening a file costs O(1): the offsets of the line starts are indexed
+    lazily, as far as the lines being accessed (the whole file when its
+    length is asked for), and each line is decoded only when it is read.
+    Only ASCII compatible encodings (UTF-8, Latin-1, cp1252...) are
+    supported.
+    """
+
+    read_only = True
+
+    def __init__(self, path, encoding=None):
+        self._file = io.open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''
+
+        sample = self._map[:4]
+        start = 0
+        if encoding is None:
+            encoding = _detect_encoding(sample)
+            if encoding == 'utf-8-sig':
+                encoding = 'utf-8'
+                start = len(codecs.BOM_UTF8)
+        if encoding.replace('_', '-').lower().startswith(('utf-16', 'utf-32')):
+            raise ValueError("{} files can not be memory-mapped.".format(encoding))
+
+        self.encoding = encoding
+        self._starts = array(_OFFSET_TYPECODE, [start])
+        self._scanned = start
+        self._complete = False
+        self.newline = u'\n'
+        if self._raw_line(0).endswith(b'\r'):
+            self.newline = u'\r\n'
+
+    def close(self):
+        """Unmaps and closes the file."""
+        if self._size:
+            self._map.close()
+        self._file.close()
+
+    def copy(self):
+        """Returns a copy of the sequence that can be read from another
+        thread, with its own mapping of the file.
+
+        The whole file is indexed first; the copy then shares the index,
+        which is not modified any more."""
+        self._scan()
+        lines = MappedLines.__new__(MappedLines)
+        lines._file = io.open(os.dup(self._file.fileno()), 'rb')
+        lines._size = self._size
+        if self._size:
+            lines._map = mmap.mmap(lines._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            lines._map = b''
+        lines.encoding = self.encoding
+        lines.newline = self.newline
+        lines._starts = self._starts
+        lines._scanned = self._scanned
+        lines._complete = True
+        return lines
+
+    def _scan(self, index=None):
+        """Extends the index of line starts until it holds the line after
+        'index', or the whole file if 'index' is None."""
+        starts = self._starts
+        size = self._size
+        while not self._complete and (index is None or len(starts) <= index + 1):
+            pos = self._scanned
+            block = self._map[pos: pos + _MMAP_SCAN_SIZE]
+            parts = block.split(b'\n')
+            parts.pop()
+            if parts:
+                for part in parts:
+                    pos += len(part) + 1
+                    starts.append(pos)
+            elif pos + len(block) < size:
+                # a line longer than the scanned block
+                pos = self._map.find(b'\n', pos + len(block))
+                if pos < 0:
+                    pos = size
+                else:
+                    pos += 1
+                    starts.append(pos)
+            else:
+                pos = size
+            self._scanned = pos
+            if pos >= size:
+                self._complete = True
+
+    def _raw_line(self, index):
+        """Returns the raw bytes of a line, including any '\\r' terminator."""
+        self._scan(index)
+        starts = self._starts
+        if index + 1 < len(starts):
+            return self._map[int(starts[index]): int(starts[index + 1]) - 1]
+        return self._map[int(starts[index]): self._size]
 
-    """Represents a list of unicode strings."""
+    def __len__(self):
+        self._scan()
+        return len(self._starts)
 
-    __slots__ = ('lines', 'caret')
+    def has_line(self, index):
+        """Returns whether there is a line at 'index', indexing the file only
+        as far as that line."""
+        self._scan(index)
+        return 0 <= index < len(self._starts)
 
-    def __init__(self, caret):
+    def __iter__(self):
+        index = 0
+        while True:
+            self._scan(index)
+            if index >= len(self._starts):
+                return
+            yield self[index]
+            index += 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(len(self)))]
+
+        if key < 0:
+            key += len(self)
+        self._scan(key)
+        if not 0 <= key < len(self._starts):
+            raise IndexError("line index out of range.")
+
+        raw = self._raw_line(key)
+        if raw.endswith(b'\r'):
+            raw = raw[:-1]
+        return raw.decode(self.encoding, 'replace')
+
+    def __setitem__(self, key, value):
+        raise TypeError("MappedLines objects are read-only.")
+
+    def __delitem__(self, key):
+        raise TypeError("MappedLines objects are read-only.")
+
+
+# Number of lines per block of a _LineOffsets index.
+_OFFSET_BLOCK_SIZE = 128
+
+
+def _fenwick_build(values):
+    """Returns a Fenwick tree (1-based list) holding the values."""
+    tree = [0] + list(values)
+    size = len(tree)
+    for index in range(1, size):
+        parent = index + (index & -index)
+        if parent < size:
+            tree[parent] += tree[index]
+    return tree
+
+
+def _fenwick_add(tree, index, delta):
+    """Adds delta to the value at (0-based) index."""
+    index += 1
+    size = len(tree)
+    while index < size:
+        tree[index] += delta
+        index += index & -index
+
+
+def _fenwick_sum(tree, index):
+    """Returns the sum of the values before (0-based) index."""
+    total = 0
+    while index > 0:
+        total += tree[index]
+        index -= index & -index
+    return total
+
+
+def _fenwick_search(tree, value):
+    """Returns the (0-based) index of the first value whose prefix sum
+    exceeds 'value', and the sum of the values before it."""
+    index = 0
+    total = 0
+    step = 1
+    while step * 2 < len(tree):
+        step *= 2
+    while step:
+        nxt = index + step
+        if nxt < len(tree) and total + tree[nxt] <= value:
+            index = nxt
+            total += tree[nxt]
+        step //= 2
+    return index, total
+
+
+class _LineOffsets(object):
+
+    """Prefix sums of the line lengths of a text, newlines included.
+
+    The lengths are kept in blocks of about _OFFSET_BLOCK_SIZE lines, with
+    Fenwick trees over the number of lines and characters of each block.
+    Changing a line length costs O(log n), inserting or removing lines
+    costs O(b + log n), b being the block size, and converting between
+    offsets and positions costs O(b + log n).
+    """
+
+    __slots__ = ('_blocks', '_counts', '_chars')
+
+    def __init__(self, lengths):
+        lengths = list(lengths)
+        size = _OFFSET_BLOCK_SIZE
+        self._blocks = [lengths[i: i + size] for i in range(0, len(lengths), size)] or [[]]
+        self._rebuild()
+
+    def _rebuild(self):
+        self._counts = _fenwick_build(len(block) for block in self._blocks)
+        self._chars = _fenwick_build(sum(block) for block in self._blocks)
+
+    def _locate(self, line):
+        """Returns the block holding a line and the line index in it."""
+        block, before = _fenwick_search(self._counts, line)
+        if block >= len(self._blocks):
+            block = len(self._blocks) - 1
+            before -= len(self._blocks[block])
+        return block, line - before
+
+    @property
+    def total(self):
+        """Gets the sum of all the lengths."""
+        return _fenwick_sum(self._chars, len(self._blocks))
+
+    def prefix(self, line):
+        """Returns the sum of the lengths of the lines before 'line'."""
+        block, index = self._locate(line)
+        return _fenwick_sum(self._chars, block) + sum(self._blocks[block][:index])
+
+    def find(self, offset):
+        """Returns the (line, column) position of an offset."""
+        block, before = _fenwick_search(self._chars, offset)
+        block = min(block, len(self._blocks) - 1)
+        before = _fenwick_sum(self._chars, block)
+        line = _fenwick_sum(self._counts, block)
+        for length in self._blocks[block]:
+            if before + length > offset:
+                break
+            before += length
+            line += 1
+        return line, offset - before
+
+    def set(self, line, length):
+        """Sets the length of a line."""
+        block, index = self._locate(line)
+        lengths = self._blocks[block]
+        _fenwick_add(self._chars, block, length - lengths[index])
+        lengths[index] = length
+
+    def splice(self, start, stop, lengths):
+        """Replaces the lengths of the lines in the [start, stop) range."""
+        if stop - start == len(lengths):
+            for index, length in enumerate(lengths):
+                self.set(start + index, length)
+            return
+
+        first, index = self._locate(start)
+        last, _ = self._locate(max(start, stop - 1))
+        merged = []
+        for block in self._blocks[first: last + 1]:
+            merged.extend(block)
+        end = index + (stop - start)
+        removed = sum(merged[index: end])
+        merged[index: end] = lengths
+
+        size = _OFFSET_BLOCK_SIZE
+        if first == last and 0 < len(merged) <= 2 * size:
+            _fenwick_add(self._counts, first, len(merged) - len(self._blocks[first]))
+            _fenwick_add(self._chars, first, sum(lengths) - removed)
+            self._blocks[first] = merged
+            return
+
+        chunks = [merged[i: i + size] for i in range(0, len(merged), size)]
+        self._blocks[first: last + 1] = chunks
+        if not self._blocks:
+            self._blocks = [[]]
+        self._rebuild()
+
+
+class _PatternCache(object):
+
+    """A least recently used cache of compiled search patterns."""
+
+    __slots__ = ('size', '_patterns')
+
+    def __init__(self, size=64):
+        self.size = size
+        self._patterns = OrderedDict()
+
+    def get(self, pattern, regex=False, ignore_case=False):
+        """Returns the compiled regular expression for a search pattern."""
+        key = (pattern, regex, ignore_case)
+        compiled = self._patterns.pop(key, None)
+        if compiled is None:
+            flags = re.UNICODE | (re.IGNORECASE if ignore_case else 0)
+            compiled = re.compile(pattern if regex else re.escape(pattern), flags)
+            if len(self._patterns) >= self.size:
+                self._patterns.popitem(last=False)
+        self._patterns[key] = compiled
+        return compiled
+
+
+_patterns = _PatternCache()
+
+
+def _search_chunk(pattern, regex, ignore_case, first, lines):
+    """Returns the (line, column, length) matches of a pattern in a chunk
+    of lines starting at line index 'first'.
+
+    This is the task run by the workers of a parallel StrList.find_all."""
+    compiled = _patterns.get(pattern, regex, ignore_case)
+    needle = None if regex or ignore_case else pattern
+    matches = []
+    for index, text in enumerate(lines, first):
+        if needle is None or needle in text:
+            for match in compiled.finditer(text):
+                matches.append((index, match.start(), match.end() - match.start()))
+    return matches
+
+
+# Process pools of the parallel searches, by number of workers.
+_search_pools = {}
+_search_pools_lock = threading.Lock()
+
+
+def _search_pool(workers):
+    """Returns the process pool with 'workers' workers shared by parallel
+    searches, starting it on first use. The pools are kept until the
+    process exits."""
+    with _search_pools_lock:
+        pool = _search_pools.get(workers)
+        if pool is None:
+            pool = _search_pools[workers] = futures.ProcessPoolExecutor(workers)
+        return pool
+
+
+class _SearchState(object):
+
+    """The lines matched by the last incremental search of a StrList."""
+
+    __slots__ = ('version', 'pattern', 'ignore_case', 'lines', 'scanned')
+
+    def __init__(self, version, pattern, ignore_case):
+        self.version = version
+        self.pattern = pattern
+        self.ignore_case = ignore_case
         self.lines = []
+        self.scanned = 0
+
+    def refines(self, version, pattern, ignore_case):
+        """Gets whether a search only has to look at the lines matched by
+        this one, i.e. the text is the same and the pattern extends this
+        one."""
+        if version != self.version or ignore_case != self.ignore_case:
+            return False
+        if ignore_case:
+            return pattern.lower().startswith(self.pattern.lower())
+        return pattern.startswith(self.pattern)
+
+
+def _trigrams(text):
+    """Returns the set of (lower case) trigrams of a string."""
+    text = text.lower()
+    return set([text[i: i + 3] for i in xrange(len(text) - 2)])
+
+
+def _required_literals(pattern, regex):
+    """Returns the literal strings any match of a pattern must contain."""
+    if not regex:
+        return [pattern]
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, TypeError, OverflowError):
+        return []
+
+    literals = []
+    run = []
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(arg))
+        else:
+            if run:
+                literals.append(u''.join(run))
+            run = []
+    if run:
+        literals.append(u''.join(run))
+    return literals
+
+
+class _TrigramIndex(object):
+
+    """Maps the trigrams found in the lines of a text to the lines holding
+    them, to narrow searches down to candidate lines.
+
+    Each line gets a stable id, so inserting or removing lines only
+    updates the postings of the lines involved. Ids match the line indexes
+    until lines are inserted or removed; from then on, the id to line
+    index map is rebuilt when needed after each such change. Trigrams
+    are indexed in lower case, so the index serves case sensitive and
+    case insensitive searches alike.
+
+    Trigrams found in more than one line out of _TRIGRAM_COMMON_RATIO are
+    too common to narrow a search: their lines are no longer recorded,
+    which bounds the size of the index on repetitive texts such as logs.
+    """
+
+    __slots__ = ('stale', '_ids', '_next_id', '_postings', '_positions',
+                 '_identity', '_common', '_limit')
+
+    def __init__(self, lines):
+        self.rebuild(lines)
+
+    def rebuild(self, lines):
+        """Indexes the given lines from scratch."""
+        self.stale = False
+        self._ids = []
+        self._next_id = 0
+        self._postings = {}
+        self._positions = None
+        self._identity = True
+        self._common = set()
+        self._limit = 0
+        self.splice(0, 0, (), lines)
+
+    def _add(self, ident, text):
+        postings = self._postings
+        for gram in _trigrams(text):
+            ids = postings.get(gram)
+            if ids is None:
+                if gram in self._common:
+                    continue
+                postings[gram] = ids = set()
+            ids.add(ident)
+            if len(ids) > self._limit:
+                del postings[gram]
+                self._common.add(gram)
+
+    def _remove(self, ident, text):
+        postings = self._postings
+        for gram in _trigrams(text):
+            ids = postings.get(gram)
+            if ids is not None:
+                ids.discard(ident)
+                if not ids:
+                    del postings[gram]
+
+    def splice(self, start, stop, old_lines, new_lines):
+        """Updates the index after the lines in the [start, stop) range,
+        'old_lines', were replaced with 'new_lines'."""
+        old_ids = self._ids[start: stop]
+        count = len(self._ids) - len(old_ids) + len(new_lines)
+        self._limit = max(_TRIGRAM_COMMON_MIN, count // _TRIGRAM_COMMON_RATIO)
+        for ident, text in zip(old_ids, old_lines):
+            self._remove(ident, text)
+
+        if len(new_lines) == len(old_ids):
+            # lines replaced in place keep their ids
+            for ident, text in zip(old_ids, new_lines):
+                self._add(ident, text)
+            return
+
+        # lines removed from, or added to, the end keep ids and indexes equal
+        at_end = self._identity and stop == len(self._ids)
+        if at_end:
+            self._next_id = start
+
+        new_ids = []
+        for text in new_lines:
+            ident = self._next_id
+            self._next_id += 1
+            self._add(ident, text)
+            new_ids.append(ident)
+        self._ids[start: stop] = new_ids
+        self._positions = None
+        self._identity = at_end
+
+    def candidates(self, pattern, regex):
+        """Returns the sorted indexes of the lines that may match a pattern,
+        or None when the pattern has no trigram to look up."""
+        grams = set()
+        for literal in _required_literals(pattern, regex):
+            grams.update(_trigrams(literal))
+        if not grams:
+            return None
+
+        postings = self._postings
+        grams.difference_update(self._common)
+        if not grams:
+            return None
+
+        found = None
+        for gram in sorted(grams, key=lambda gram: len(postings.get(gram, ()))):
+            ids = postings.get(gram)
+            if not ids:
+                return []
+            found = set(ids) if found is None else found & ids
+            if not found:
+                return []
+
+        if self._identity:
+            return sorted(found)
+        if self._positions is None:
+            self._positions = dict(zip(self._ids, xrange(len(self._ids))))
+        positions = self._positions
+        return sorted(positions[ident] for ident in found)
+
+    def memory(self):
+        """Returns an estimate of the memory used by the index, in bytes."""
+        size = sys.getsizeof(self._ids) + sys.getsizeof(self._postings)
+        size += sum(sys.getsizeof(gram) + sys.getsizeof(ids)
+                    for gram, ids in self._postings.iteritems())
+        size += sys.getsizeof(self._common) + sum(sys.getsizeof(gram) for gram in self._common)
+        if self._positions is not None:
+            size += sys.getsizeof(self._positions)
+        return size
+
+
+# Default number of undo groups and of bytes kept by an _UndoJournal.
+_UNDO_DEPTH = 1000
+_UNDO_SIZE = 1 << 24
+
+# Deltas of a typing run are merged while their text is shorter than this.
+_UNDO_MERGE_SIZE = 256
+
+
+def _text_end(line, column, text):
+    """Returns the (line, column) position where 'text' ends when inserted
+    at (line, column)."""
+    newlines = text.count(u'\n')
+    if not newlines:
+        return line, column + len(text)
+    return line + newlines, len(text) - text.rfind(u'\n') - 1
+
+
+class _UndoGroup(object):
+
+    """The deltas of one operation and the caret states around it."""
+
+    __slots__ = ('kind', 'deltas', 'before', 'after', 'size', 'multiline')
+
+    def __init__(self, kind, before):
+        self.kind = kind
+        self.deltas = []
+        self.before = before
+        self.after = None
+        self.size = 0
+        self.multiline = False
+
+    def append(self, delta):
+        """Adds a (line, column, removed, inserted) delta, merging it into
+        the previous one when both belong to the same typing run."""
+        line, column, removed, inserted = delta
+        self.multiline = self.multiline or u'\n' in removed or u'\n' in inserted
+        if self.deltas and not self.multiline:
+            pline, pcolumn, premoved, pinserted = last = self.deltas[-1]
+            if pline == line and len(premoved) + len(pinserted) < _UNDO_MERGE_SIZE:
+                merged = None
+                if not removed and not premoved and column == pcolumn + len(pinserted):
+                    merged = (line, pcolumn, u'', pinserted + inserted)
+                elif not inserted and not pinserted and column + len(removed) == pcolumn:
+                    merged = (line, column, removed + premoved, u'')
+                elif not inserted and not pinserted and column == pcolumn:
+                    merged = (line, column, premoved + removed, u'')
+                if merged is not None:
+                    self.size -= sys.getsizeof(premoved) + sys.getsizeof(pinserted)
+                    self.deltas[-1] = delta = merged
+                    self.size += sys.getsizeof(delta[2]) + sys.getsizeof(delta[3])
+                    return
+        self.deltas.append(delta)
+        self.size += sys.getsizeof(removed) + sys.getsizeof(inserted) + sys.getsizeof(delta)
+
+
+class _UndoJournal(object):
+
+    """Records the edits of a StrList as compact deltas for undo and redo.
+
+    Each delta is a (line, column, removed, inserted) tuple. The deltas of
+    an operation form a group, along with the caret states before and
+    after it; consecutive typing (or erasing) operations share a group.
+    The oldest groups are dropped beyond 'depth' groups or 'limit' bytes."""
+
+    __slots__ = ('depth', 'limit', 'size', 'undos', 'redos', 'group', 'nesting', 'replaying')
+
+    # operations whose consecutive groups are merged
+    _runs = {
+        Caret.MODINSERTCHAR: Caret.MODINSERTCHAR,
+        Caret.MODINSERTWORD: Caret.MODINSERTCHAR,
+        Caret.MODREPLACECHAR: Caret.MODINSERTCHAR,
+        Caret.MODERASECHAR: Caret.MODERASECHAR,
+        Caret.MODDELETECHAR: Caret.MODDELETECHAR,
+    }
+
+    def __init__(self, depth=_UNDO_DEPTH, limit=_UNDO_SIZE):
+        self.depth = depth
+        self.limit = limit
+        self.size = 0
+        self.undos = deque()
+        self.redos = []
+        self.group = None
+        self.nesting = 0
+        self.replaying = False
+
+    def clear(self):
+        self.size = 0
+        self.undos.clear()
+        del self.redos[:]
+
+    def begin(self, kind, state):
+        """Starts the group of an operation; calls may nest."""
+        self.nesting += 1
+        if self.nesting == 1:
+            self.group = _UndoGroup(self._runs.get(kind), state)
+
+    def end(self, state):
+        """Ends the group started by the outermost begin()."""
+        self.nesting -= 1
+        if self.nesting:
+            return
+        group, self.group = self.group, None
+        if not group.deltas:
+            return
+        group.after = state
+
+        last = self.undos[-1] if self.undos else None
+        if (last is not None and group.kind is not None and last.kind == group.kind
+                and last.after == group.before and not last.multiline and not group.multiline):
+            self.size -= last.size
+            for delta in group.deltas:
+                last.append(delta)
+            last.after = group.after
+            self.size += last.size
+        else:
+            self.undos.append(group)
+            self.size += group.size
+        self._evict()
+
+    @property
+    def recording(self):
+        """Gets whether edits are to be recorded."""
+        return self.depth > 0 and not self.replaying
+
+    def record(self, line, column, removed, inserted):
+        """Records the replacement of 'removed' with 'inserted' at
+        (line, column), within the current group."""
+        if self.redos:
+            del self.redos[:]
+        self.group.append((line, column, removed, inserted))
+
+    def _evict(self):
+        undos = self.undos
+        while undos and (len(undos) > self.depth or self.size > self.limit):
+            self.size -= undos.popleft().size
+
+
+# Seconds the writer of an _EditJournal waits for more edits between syncs.
+_JOURNAL_SYNC_DELAY = 0.5
+
+# Size in bytes beyond which an _EditJournal is compacted into its base file.
+_JOURNAL_COMPACT_SIZE = 1 << 26
+
+# Number of lines encoded at once when an _EditJournal writes its base file.
+_JOURNAL_CHUNK_LINES = 4096
+
+
+def _file_digest(path):
+    """Returns the (size, CRC-32) of a file."""
+    size = 0
+    crc = 0
+    with io.open(path, 'rb') as stream:
+        while True:
+            data = stream.read(_IO_CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            crc = zlib.crc32(data, crc)
+    return size, crc & 0xffffffff
+
+
+def _rename(source, target):
+    """Renames a file, replacing the target if it exists."""
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+class _EditJournal(object):
+
+    """Appends the edits of a StrList to a journal file kept next to its
+    base file, syncing them to disk in batches on a background thread, and
+    compacts them into the base file when asked to.
+
+    The journal starts with a header holding the size and CRC-32 of the
+    base file it applies to, so the journal left over by an interrupted
+    compaction is recognized and ignored. Each following line is an edit,
+    a JSON [line, column, end_line, end_column, text] list."""
+
+    __slots__ = ('path', 'journal_path', 'encoding', 'newline', 'sync_delay',
+                 'compact_size', 'size', 'stale', 'error',
+                 '_queue', '_queued', '_written', '_closed', '_cond', '_wake',
+                 '_stream', '_thread')
+
+    def __init__(self, path, journal_path, encoding, newline,
+                 sync_delay=_JOURNAL_SYNC_DELAY, compact_size=_JOURNAL_COMPACT_SIZE):
+        self.path = path
+        self.journal_path = journal_path
+        self.encoding = encoding
+        self.newline = newline
+        self.sync_delay = sync_delay
+        self.compact_size = compact_size
+        self.size = 0
+        self.stale = False
+        self.error = None
+        self._queue = deque()
+        self._queued = 0
+        self._written = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stream = None
+        self._thread = None
+
+    def start(self, lines, digest=None, append=False):
+        """Starts writing, appending to the current journal if 'append' is
+        true, or starting a new journal for the base file whose (size,
+        CRC-32) is 'digest' otherwise. Without a base file, 'lines' are
+        written to a new one first."""
+        if append:
+            self._stream = io.open(self.journal_path, 'ab')
+            self.size = self._stream.tell()
+        elif digest is not None:
+            self._start_journal(digest)
+        else:
+            self._compact(lines)
+        self._thread = threading.Thread(target=self._run, name='StrList journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _start_journal(self, digest):
+        temp = self.journal_path + '.tmp'
+        with io.open(temp, 'wb') as stream:
+            stream.write(json.dumps({'size': digest[0], 'crc': digest[1]}) + '\n')
+            stream.flush()
+            os.fsync(stream.fileno())
+        if self._stream is not None:
+            self._stream.close()
+        _rename(temp, self.journal_path)
+        self._stream = io.open(self.journal_path, 'ab')
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item):
+        self._check()
+        with self._cond:
+            self._queue.append(item)
+            self._queued += 1
+            self._cond.notify()
+
+    def append(self, line, column, end_line, end_column, text):
+        """Queues an edit to be written to the journal.
+
+        Raises UnicodeEncodeError, queuing nothing, if 'text' can not be
+        encoded in the encoding of the base file."""
+        text.encode(self.encoding)
+        data = json.dumps([line, column, end_line, end_column, text]) + '\n'
+        self.size += len(data)
+        self._put(data)
+
+    def compact(self, lines):
+        """Queues the writing of 'lines', a snapshot of the whole text, to
+        the base file, after which the journal starts anew."""
+        self.size = 0
+        self.stale = False
+        self._put(lines)
+
+    def sync(self):
+        """Waits until everything queued so far is on disk."""
+        with self._cond:
+            target = self._queued
+            self._wake.set()
+            while self._written < target and self.error is None:
+                self._cond.wait(0.1)
+        self._check()
+
+    def close(self):
+        """Writes what is left and stops the writer."""
+        with self._cond:
+            self._closed = True
+            self._wake.set()
+            self._cond.notify()
+        self._thread.join()
+        self._stream.close()
+        self._check()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                items = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+            if items and self.error is None:
+                try:
+                    self._write(items)
+                except Exception as error:
+                    # raised by the next call made from the editing thread
+                    self.error = error
+            with self._cond:
+                self._written += len(items)
+                self._cond.notify_all()
+            if closed and not items:
+                return
+            # let the edits of the next moments gather into one sync
+            self._wake.wait(self.sync_delay)
+            self._wake.clear()
+
+    def _write(self, items):
+        stream = self._stream
+        for item in items:
+            if isinstance(item, str):
+                stream.write(item)
+            else:
+                stream.flush()
+                self._compact(item)
+                stream = self._stream
+        stream.flush()
+        os.fsync(stream.fileno())
+
+    def _compact(self, lines):
+        # The new base and journal are written aside and renamed in this
+        # order: a crash in between leaves the old journal, which does not
+        # match the new base and is thus ignored.
+        temp = self.path + '.tmp'
+        encoder = codecs.getincrementalencoder(self.encoding)()
+        size = 0
+        crc = 0
+        try:
+            with io.open(temp, 'wb') as stream:
+                for start in xrange(0, len(lines), _JOURNAL_CHUNK_LINES):
+                    text = self.newline.join(lines[start: start + _JOURNAL_CHUNK_LINES])
+                    if start:
+                        text = self.newline + text
+                    data = encoder.encode(text)
+                    stream.write(data)
+                    size += len(data)
+                    crc = zlib.crc32(data, crc)
+                data = encoder.encode(u'', True)
+                stream.write(data)
+                size += len(data)
+                crc = zlib.crc32(data, crc)
+                stream.flush()
+                os.fsync(stream.fileno())
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        _rename(temp, self.path)
+        self._start_journal((size, crc & 0xffffffff))
+
+
+# Number of lines whose word boundaries are kept by a _WordBoundaries.
+_WORD_CACHE_SIZE = 256
+
+
+class _WordBoundaries(object):
+
+    """Finds the word boundaries of lines and caches them.
+
+    Characters fall in three classes: whitespace, word characters (letters,
+    digits and 'word_chars') and punctuation (anything else). A word is a
+    run of non-whitespace characters of the same class. The boundaries of
+    a line are kept until its string changes, which any edit does."""
+
+    __slots__ = ('word_chars', 'whitespace', '_pattern', '_cache')
+
+    def __init__(self, word_chars=u'_', whitespace=u' \t'):
+        self.word_chars = word_chars
+        self.whitespace = whitespace
+        word = re.escape(word_chars)
+        space = re.escape(whitespace)
+        runs = [u'[\\w{0}]+'.format(word), u'[^\\w{0}{1}]+'.format(word, space)]
+        if whitespace:
+            runs.insert(0, u'([{0}]+)'.format(space))
+        self._pattern = re.compile(u'|'.join(runs), re.UNICODE)
+        self._cache = OrderedDict()
+
+    def _boundaries(self, index, text):
+        """Returns the starts of the runs of a line and of its words."""
+        entry = self._cache.pop(index, None)
+        if entry is None or entry[0] is not text:
+            starts = []
+            words = []
+            for match in self._pattern.finditer(text):
+                starts.append(match.start())
+                if match.lastindex is None:
+                    words.append(match.start())
+            entry = (text, starts, words)
+            if len(self._cache) >= _WORD_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        self._cache[index] = entry
+        return entry[1], entry[2]
+
+    def prev_word(self, index, text, column):
+        """Returns the start of the word before column, or None."""
+        words = self._boundaries(index, text)[1]
+        pos = bisect_left(words, column) - 1
+        return words[pos] if pos >= 0 else None
+
+    def next_word(self, index, text, column):
+        """Returns the start of the word after column, or None."""
+        words = self._boundaries(index, text)[1]
+        pos = bisect_right(words, column)
+        return words[pos] if pos < len(words) else None
+
+    def run_end(self, index, text, column):
+        """Returns the end of the run of characters of the same class at
+        column."""
+        starts = self._boundaries(index, text)[0]
+        pos = bisect_right(starts, column)
+        return starts[pos] if pos < len(starts) else len(text)
+
+
+class _CaretFixups(object):
+
+    """Keeps caret positions up to date while the text is edited from back
+    to front.
+
+    Positions are added in descending order and every edit is expected to
+    start before the positions added so far; the ones it overlaps move to
+    its end. Positions sharing a line form a group, whose line and column
+    shift are updated once per edit, while the lines of the other groups
+    are shifted lazily. A whole pass thus costs time linear in the number
+    of positions and edits.
+
+    'floor' is the start of the first edit in the text, if any."""
+
+    __slots__ = ('floor', '_groups', '_shift')
+
+    def __init__(self):
+        self.floor = None
+        # [line minus shift, column shift, [(caret, is_anchor, column)]]
+        self._groups = []
+        self._shift = 0
+
+    def add(self, caret, anchor=False):
+        """Adds the position of a caret, or of its selection anchor."""
+        if anchor:
+            self._put(caret, True, caret.sline, caret.scolumn)
+        else:
+            self._put(caret, False, caret.line, caret.column)
+
+    def _put(self, caret, anchor, line, column):
+        groups = self._groups
+        if groups and groups[-1][0] + self._shift == line:
+            group = groups[-1]
+        else:
+            group = [line - self._shift, 0, []]
+            groups.append(group)
+        group[2].append((caret, anchor, column - group[1]))
+
+    def edit(self, line, column, end_line, end_column, new_line, new_column):
+        """Moves the positions after an edit of the text from (line, column)
+        to (end_line, end_column), which now ends at (new_line, new_column)."""
+        if self.floor is None or (line, column) < self.floor:
+            self.floor = (line, column)
+
+        groups = self._groups
+        overlapped = []
+        while groups:
+            group = groups[-1]
+            group_line = group[0] + self._shift
+            if group_line > end_line:
+                break
+            entries = group[2]
+            while entries and (group_line, entries[-1][2] + group[1]) < (end_line, end_column):
+                overlapped.append(entries.pop())
+            if entries:
+                break
+            groups.pop()
+
+        shift = self._shift + new_line - end_line
+        if groups and groups[-1][0] + self._shift == end_line:
+            group = groups[-1]
+            group[0] = new_line - shift
+            group[1] += new_column - end_column
+        self._shift = shift
+        for caret, anchor, old in reversed(overlapped):
+            self._put(caret, anchor, new_line, new_column)
+
+    def apply(self):
+        """Stores the positions back into their carets."""
+        for base, delta, entries in self._groups:
+            line = base + self._shift
+            for caret, anchor, column in entries:
+                if anchor:
+                    caret.sline, caret.scolumn = line, column + delta
+                else:
+                    caret.line, caret.column = line, column + delta
+
+
+class TextChanges(object):
+
+    """The changes made to a StrList since they were last consumed, as
+    returned by StrList.changes().
+
+    'lines' holds the indexes of the lines modified in place. 'shifted'
+    is the index of the first line from which lines were inserted or
+    removed, so every line from it on has to be considered modified, or
+    None. 'caret' and 'viewport' tell whether the caret (or selection)
+    and the page position or size changed.
+    """
+
+    __slots__ = ('lines', 'shifted', 'caret', 'viewport')
+
+    def __init__(self):
+        self.lines = set()
+        self.shifted = None
+        self.caret = False
+        self.viewport = False
+
+    def __nonzero__(self):
+        return self.text_changed or self.caret or self.viewport
+
+    def __contains__(self, line):
+        """Gets whether a line was modified."""
+        return line in self.lines or (self.shifted is not None and line >= self.shifted)
+
+    @property
+    def text_changed(self):
+        """Gets whether any line was modified."""
+        return bool(self.lines) or self.shifted is not None
+
+    def _splice(self, start, stop, count):
+        """Records that the lines in the [start, stop) range were replaced
+        with 'count' lines."""
+        shifted = self.shifted
+        if count == stop - start:
+            if shifted is not None:
+                stop = min(stop, shifted)
+            self.lines.update(xrange(start, stop))
+        elif shifted is None or start < shifted:
+            self.shifted = start
+            self.lines = set(line for line in self.lines if line < start)
+
+
+class SelectionView(object):
+
+    """A read-only, sequence-like view of a range of text in a StrList.
+
+    The view does not copy the text: the first and last lines are sliced
+    when they are accessed and the lines in between are returned as they
+    are stored. The view reflects the StrList contents at the time it is
+    accessed, so it should not outlive modifications of the text.
+    """
+
+    __slots__ = ('strlist', 'start', 'end')
+
+    def __init__(self, strlist, start, end):
+        self.strlist = strlist
+        self.start = tuple(start)
+        self.end = tuple(end)
+
+    def __len__(self):
+        return self.end[0] - self.start[0] + 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(len(self)))]
+
+        size = len(self)
+        index = key + size if key < 0 else key
+        if not 0 <= index < size:
+            raise IndexError("selection index out of range.")
+
+        text = self.strlist[self.start[0] + index]
+        if index == size - 1:
+            text = text[:self.end[1]]
+        if index == 0:
+            text = text[self.start[1]:]
+        return text
+
+    def __repr__(self):
+        return 'SelectionView({!r}, {!r})'.format(self.start, self.end)
+
+    def to_list(self):
+        """Returns a list holding a copy of the selected lines."""
+        return list(self)
+
+    def to_text(self, newline=u'\n'):
+        """Returns the selected text as a single string."""
+        return newline.join(self)
+
+
+class Viewport(object):
+
+    """A fixed-size grid of the text visible in the page of a StrList, as
+    returned by StrList.viewport().
+
+    'rows' holds one string per line of the page, padded with spaces to
+    the width of the page. The list is kept and updated in place: only the
+    rows whose lines changed (listed in 'dirty' after each update) or that
+    scrolled into view are recomputed. 'caret' is the (row, column) cell
+    of the caret in the grid, or None when it is out of the page, and
+    'spans' holds a (row, start, stop) tuple for each row with selected
+    cells.
+    """
+
+    __slots__ = ('strlist', 'rows', 'dirty', 'caret', 'spans',
+                 'page_pos', 'page_size', '_changes', '_blank')
+
+    def __init__(self, strlist):
+        self.strlist = strlist
+        self.rows = []
+        self.dirty = set()
+        self.caret = None
+        self.spans = []
+        self.page_pos = None
+        self.page_size = None
+        self._changes = TextChanges()
+        self._blank = u''
+        strlist.add_listener(self._listener)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, row):
+        return self.rows[row]
+
+    def _listener(self, start, stop, count):
+        if stop is None:
+            self._changes.shifted = 0
+        else:
+            self._changes._splice(start, stop, count)
+
+    def _draw(self, first, last):
+        """Recomputes the rows showing lines first to last."""
+        strlist = self.strlist
+        column, top = self.page_pos
+        width, height = self.page_size
+        first = max(first, top)
+        last = min(last, top + height)
+        for index in xrange(first, last):
+            row = index - top
+            if strlist._has_line(index):
+                self.rows[row] = strlist[index][column: column + width].ljust(width)
+            else:
+                self.rows[row] = self._blank
+            self.dirty.add(row)
+
+    def update(self):
+        """Brings the grid up to date with the text and the caret."""
+        caret = self.strlist.caret
+        changes = self._changes
+        self._changes = TextChanges()
+        self.dirty.clear()
+
+        column, top = caret.page_pos
+        width, height = caret.page_size
+        if self.page_pos is None or (column, width, height) != (self.page_pos[0],) + self.page_size:
+            # a new page size or horizontal position; start over
+            self._blank = u' ' * width
+            self.rows[:] = [self._blank] * height
+            self.page_pos = (column, top)
+            self.page_size = (width, height)
+            self._draw(top, top + height)
+            self.dirty.update(xrange(height))
+        else:
+            delta = top - self.page_pos[1]
+            self.page_pos = (column, top)
+            if 0 < delta < height:
+                self.rows[:] = self.rows[delta:] + self.rows[:delta]
+                self.dirty.update(xrange(height))
+                self._draw(top + height - delta, top + height)
+            elif 0 < -delta < height:
+                self.rows[:] = self.rows[delta:] + self.rows[:delta]
+                self.dirty.update(xrange(height))
+                self._draw(top, top - delta)
+            elif delta:
+                self._draw(top, top + height)
+            if changes.shifted is not None:
+                self._draw(changes.shifted, top + height)
+            for index in changes.lines:
+                if top <= index < top + height:
+                    self._draw(index, index + 1)
+
+        row = caret.line - top
+        col = caret.column - column
+        self.caret = (row, col) if 0 <= row < height and 0 <= col < width else None
+
+        del self.spans[:]
+        bounds = self.strlist._selection_bounds()
+        if bounds is not None:
+            line, start, end_line, end = bounds
+            for index in xrange(max(line, top), min(end_line + 1, top + height)):
+                first = start if index == line else 0
+                last = end if index == end_line else self.strlist._line_length(index) + 1
+                first = max(first - column, 0)
+                last = min(last - column, width)
+                if first < last:
+                    self.spans.append((index - top, first, last))
+        return self
+
+    def close(self):
+        """Stops following the changes of the StrList."""
+        self.strlist.remove_listener(self._listener)
+
+
+class TextSnapshot(object):
+
+    """An immutable view of the text of a StrList at a given version.
+
+    A snapshot shares the chunks of lines of the text it was taken from,
+    so taking one is cheap, and it can be read from other threads (e.g.
+    to save or search the text) while the text is being edited.
+    """
+
+    __slots__ = ('_lines', 'version', 'encoding', 'newline')
+
+    def __init__(self, lines, version, encoding, newline):
+        self._lines = lines
+        self.version = version
+        self.encoding = encoding
+        self.newline = newline
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __getitem__(self, key):
+        return self._lines[key]
+
+    def __contains__(self, item):
+        return item in self._lines
+
+    def to_text(self, newline=None):
+        """Returns the whole text as a single string."""
+        return (newline or self.newline).join(self._lines)
+
+    def save(self, target, encoding=None, newline=None):
+        """Saves the text to a file, like StrList.save()."""
+        _save_lines(self._lines, target, encoding or self.encoding, newline or self.newline)
+
+
+class StrList(object):
+
+    """Represents a list of unicode strings.
+
+    The lines are kept in a list-like storage object, a plain list by
+    default. Any object supporting len(), iteration, indexing and slice
+    assignment can be used instead, e.g. a LineRope for very large texts.
+
+    Single line edits are applied to an 'active line' gap buffer and only
+    written back to the storage when another line is edited, when the
+    caret leaves the line or when the text is read.
+    """
+
+    __slots__ = ('_lines', 'caret', 'encoding', 'newline',
+                 '_active', '_active_line', '_active_dirty', '_touched', '_offsets',
+                 '_version', '_search_state', '_trigrams',
+                 '_changes', '_listeners', '_caret_state', '_view_state', '_viewport',
+                 '_words', '_indents', '_carets', '_fixups', '_journal', '_wal', '_mirror')
+
+    def __init__(self, caret, storage=None):
+        self._lines = storage if storage is not None else []
         self.caret = caret
+        self.encoding = 'utf-8'
+        self.newline = u'\n'
+        self._active = None
+        self._active_line = 0
+        self._active_dirty = False
+        self._touched = None
+        self._offsets = None
+        self._version = 0
+        self._search_state = None
+        self._trigrams = None
+        self._changes = TextChanges()
+        self._listeners = []
+        self._caret_state = None
+        self._view_state = None
+        self._viewport = None
+        self._words = _WordBoundaries()
+        self._indents = None
+        self._carets = []
+        self._fixups = None
+        self._journal = _UndoJournal()
+        self._wal = None
+        self._mirror = None
 
     def __len__(self):
-        return len(self.lines)
+        return len(self._lines)
 
     def __iter__(self):
-        return iter(self.lines)
+        self._flush_active()
+        return iter(self._lines)
 
     def __getitem__(self, key):
-        return self.lines[key]
+        self._flush_active()
+        return self._lines[key]
 
     def __setitem__(self, key, value):
         """StrList has strict use of setitem method.
@@ -226,15 +1994,168 @@ class StrList(object):
         if isinstance(key, int):
             if not isinstance(value, (str, unicode)):
                 raise ValueError("str or unicode string expected.")
-            self.lines[key] = unicode(value)
+            key = self._line_index(key)
+            self._replace_lines(key, 0, key, self._line_length(key), [unicode(value)])
         else:
             raise KeyError("int key expected.")
 
     def __delitem__(self, key):
-        del self.lines[key]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise KeyError("extended slices are not supported.")
+        else:
+            start = self._line_index(key)
+            stop = start + 1
+        if start >= stop:
+            return
+
+        # the lines are deleted as text, along with a line break, so the
+        # edit can be undone and journaled; only deleting every line can not
+        if stop < len(self):
+            self._replace_lines(start, 0, stop, 0, [u''])
+        elif start > 0:
+            self._replace_lines(start - 1, self._line_length(start - 1),
+                                stop - 1, self._line_length(stop - 1), [u''])
+        else:
+            self._release_active()
+            self._splice_lines(start, stop, [])
+            self._journal.clear()
+            if self._wal is not None:
+                self._wal.stale = True
 
     def __contains__(self, item):
-        return item in self.lines
+        self._flush_active()
+        return item in self._lines
+
+    @property
+    def lines(self):
+        """Gets or sets the line storage.
+
+        Getting the storage writes back any pending edit. A caller that
+        modifies it directly must call invalidate() afterwards."""
+        self._flush_active()
+        return self._lines
+
+    @lines.setter
+    def lines(self, value):
+        # a storage with a close() method (e.g. MappedLines) is closed
+        close = getattr(self._lines, 'close', None)
+        if close is not None and self._lines is not value:
+            close()
+        self._active = None
+        self._active_dirty = False
+        self._drop_indexes()
+        self._lines = value
+
+    def invalidate(self):
+        """Tells that the line storage was modified directly.
+
+        Drops the active line buffer, the indexes kept on the text and the
+        undo history, and marks the edit journal for compaction."""
+        self._active = None
+        self._active_dirty = False
+        self._drop_indexes()
+
+    @property
+    def version(self):
+        """Gets a number that changes each time the text is modified."""
+        return self._version
+
+    def snapshot(self):
+        """Returns a TextSnapshot of the current version of the text.
+
+        A LineRope storage is shared as is. A MappedLines storage is fully
+        indexed and then copied. Any other modifiable storage is mirrored,
+        from the first snapshot on, by a LineRope kept up to date with
+        every edit, so that taking a snapshot costs O(1) apart from writing
+        back the active line buffer."""
+        self._flush_active()
+        lines = self._lines
+        if isinstance(lines, (LineRope, MappedLines)):
+            lines = lines.copy()
+        elif not self.read_only:
+            if self._mirror is None:
+                self._mirror = LineRope(lines)
+            lines = self._mirror.copy()
+        return TextSnapshot(lines, self._version, self.encoding, self.newline)
+
+    def _drop_indexes(self):
+        """Drops the indexes kept on the text; they are rebuilt on demand."""
+        self._version += 1
+        self._offsets = None
+        self._indents = None
+        self._mirror = None
+        self._journal.clear()
+        if self._wal is not None:
+            self._wal.stale = True
+        if self._trigrams is not None:
+            self._trigrams.stale = True
+        self._changes.lines = set()
+        self._changes.shifted = 0
+        for listener in self._listeners:
+            listener(0, None, None)
+
+    def changes(self):
+        """Returns the TextChanges made since the previous call (e.g. during
+        the last frame) and starts recording anew."""
+        changes = self._changes
+        self._changes = TextChanges()
+
+        caret = self.caret
+        state = (caret.line, caret.column, caret.selecting, caret.sline, caret.scolumn)
+        view = (caret.page_pos, caret.page_size)
+        changes.caret = state != self._caret_state
+        changes.viewport = view != self._view_state
+        self._caret_state = state
+        self._view_state = view
+        return changes
+
+    def viewport(self):
+        """Returns the Viewport of the page, updated to the current text.
+
+        The same Viewport is returned on every call, so renderers may keep
+        references to it and its rows."""
+        if self._viewport is None:
+            self._viewport = Viewport(self)
+        return self._viewport.update()
+
+    def add_listener(self, listener):
+        """Registers a callable to be notified of each modification.
+
+        The listener is called as listener(start, stop, count) when the
+        lines in the [start, stop) range are replaced with 'count' lines,
+        and as listener(0, None, None) when the whole storage may have
+        changed (e.g. it was replaced or handed out by the 'lines'
+        property)."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregisters a listener added by add_listener()."""
+        self._listeners.remove(listener)
+
+    def _line_index(self, key):
+        """Normalizes a (possibly negative) line index."""
+        index = key + len(self) if key < 0 else key
+        if not self._has_line(index):
+            raise IndexError("line index out of range.")
+        return index
+
+    def _has_line(self, index):
+        """Returns whether there is a line at 'index'.
+
+        A storage with a has_line() method (e.g. MappedLines) is asked
+        instead of counting its lines, which may index a whole file."""
+        has_line = getattr(self._lines, 'has_line', None)
+        if has_line is not None:
+            return has_line(index)
+        return 0 <= index < len(self._lines)
+
+    def _bound_line(self, index):
+        """Returns the line index closest to 'index' within the text."""
+        if index < 0 or self._has_line(index):
+            return max(0, index)
+        return max(0, len(self) - 1)
 
     @property
     def is_first_line(self):
@@ -245,7 +2166,8 @@ class StrList(object):
     def is_last_line(self):
         """Gets whether the current line index is the index of
         the last line of text."""
-        return self.caret.line == len(self) - 1
+        line = self.caret.line
+        return self._has_line(line) and not self._has_line(line + 1)
 
     @property
     def last_line(self):
@@ -258,13 +2180,12 @@ class StrList(object):
         
         Note that the last column is always equal to the length
         of the string."""
-        return len(self.current_line)
+        return self._line_length(self._bound_line(self.caret.line))
 
     @property
     def current_line(self):
         """Gets the string of the current line index."""
-        ind = max(0, min(len(self.lines)-1, self.caret.line))
-        return self.lines[ind]
+        return self[self._bound_line(self.caret.line)]
 
     @property
     def has_selection(self):
@@ -273,401 +2194,1419 @@ class StrList(object):
             return self.caret.sline != self.caret.line or self.caret.scolumn != self.caret.column
         return False
 
-    def get_selection(self):
-        """Returns a sequence of strings reflecting the text selected, or None."""
-
-        if self.caret.line < self.caret.sline:
-            startline = self.caret.line
-            endline = self.caret.sline
-            startcolumn = self.caret.column
-            endcolumn = self.caret.scolumn
-        elif self.caret.line > self.caret.sline:
-            startline = self.caret.sline
-            endline = self.caret.line
-            startcolumn = self.caret.scolumn
-            endcolumn = self.caret.column
-        else:
-            startline = endline = self.caret.line
-            if self.caret.column > self.caret.scolumn:
-                startcolumn = self.caret.scolumn
-                endcolumn = self.caret.column
-            elif self.caret.column < self.caret.scolumn:
-                startcolumn = self.caret.column
-                endcolumn = self.caret.scolumn
-            else:
-                return
-
-        numlines = endline - startline
-        if numlines == 0:
-            return [self[startline][startcolumn: endcolumn + 1]]
-        elif numlines == 1:
-            return [
-                self[startline][startcolumn:],
-                self[endline][:endcolumn]
-            ]
-        else:
-            lines = [self[startline][startcolumn:]]
-
-            for i in range(startline + 1, endline):
-                lines.append(self[i])
+    def _selection_bounds(self):
+        """Returns the (line, column, end_line, end_column) position of the
+        selected text, or None."""
+        if not self.has_selection:
+            return None
+        start = self._clamp(self.caret.sline, self.caret.scolumn)
+        end = self._clamp(self.caret.line, self.caret.column)
+        if end < start:
+            start, end = end, start
+        return start + end
+
+    def _clamp(self, line, column):
+        """Returns the closest position to (line, column) within the text."""
+        if not self._has_line(0):
+            return 0, 0
+        if not self._has_line(line):
+            line = len(self) - 1
+            column = self._line_length(line)
+        return line, min(column, self._line_length(line))
 
-            lines.append(self[endline][:endcolumn])
+    def get_selection(self):
+        """Returns a SelectionView of the text selected, or None."""
+        bounds = self._selection_bounds()
+        if bounds is not None:
+            return SelectionView(self, bounds[:2], bounds[2:])
 
-            return lines
+    def set_word_classes(self, word_chars=u'_', whitespace=u' \t'):
+        """Sets the characters that, besides letters and digits, make up
+        words and the ones that separate them, for the word operations."""
+        self._words = _WordBoundaries(word_chars, whitespace)
 
     def get_indent_length(self, line_index):
-        """Returns the indentation level of the given line."""
-        # TODO: find a better way to calculate the indent level.
-        for i, ch in enumerate(self[line_index]):
-            if ch != ' ':
-                return i
+        """Returns the length of the indentation (the leading spaces and
+        tabs) of the given line.
+
+        The lengths are cached until the lines are modified."""
+        index = self._line_index(line_index)
+        if self._active is not None and index == self._active_line:
+            return self._active.leading(u' \t')
+
+        # the lines of a read-only storage are not counted nor cached
+        indents = self._indents
+        if indents is None and not self.read_only:
+            indents = self._indents = [None] * len(self)
+        length = indents[index] if indents is not None else None
+        if length is None:
+            text = self._lines[index]
+            length = len(text) - len(text.lstrip(u' \t'))
+            if indents is not None:
+                indents[index] = length
+        return length
+
+    def _leading_spaces(self, index):
+        """Returns the number of leading spaces of a line."""
+        if self._active is not None and index == self._active_line:
+            return self._active.leading(u' ')
+        text = self._lines[index]
+        return len(text) - len(text.lstrip(u' '))
+
+    def _newline_indent(self, line, column):
+        """Returns the indentation of a line broken from 'line' at 'column',
+        as set by the Caret.AUTOINDENT option.
+
+        The new line takes the indentation of the broken one, one level more
+        if the text before the break ends with one of the caret's
+        'indent_tokens', or one level less if it starts with one of its
+        'dedent_tokens'."""
+        text = self[line]
+        indent = text[:min(self.get_indent_length(line), column)]
+        head = text[len(indent): column].rstrip()
+        words = head.split(None, 1)
+        if any(head.endswith(token) for token in self.caret.indent_tokens):
+            indent += u' ' * self.caret.indent
+        elif words and words[0] in self.caret.dedent_tokens:
+            indent = indent[:max(0, len(indent) - self.caret.indent)]
+        return indent
+
+    def indent_lines(self, first, last):
+        """Indents the lines in the [first, last] range by one level.
+
+        Empty lines are left as they are."""
+        self._journal.begin(None, self._caret_states())
+        try:
+            self._shift_lines(first, last, self.caret.indent)
+        finally:
+            self._journal.end(self._caret_states())
+
+    def dedent_lines(self, first, last):
+        """Removes one level of indentation (or a tab) from the lines in the
+        [first, last] range."""
+        self._journal.begin(None, self._caret_states())
+        try:
+            self._shift_lines(first, last, -self.caret.indent)
+        finally:
+            self._journal.end(self._caret_states())
+
+    def _shift_lines(self, first, last, amount):
+        """Adds 'amount' spaces to the indentation of the lines in the
+        [first, last] range, or removes them if negative, replacing the
+        range at once."""
+        first = self._line_index(first)
+        last = self._line_index(last)
+        self._release_active()
+        lines = self._lines[first: last + 1]
+        shifts = []
+        parts = []
+        for index, text in enumerate(lines, first):
+            if amount > 0:
+                shift = amount if text else 0
+                parts.append(u' ' * shift + text)
+            else:
+                prefix = text[:min(-amount, self.get_indent_length(index))]
+                shift = -(prefix.find(u'\t') + 1 or len(prefix))
+                parts.append(text[-shift:])
+            shifts.append(shift)
+        if not any(shifts):
+            return
+
+        self._replace_lines(first, 0, last, len(lines[-1]), parts)
+        caret = self.caret
+        if first <= caret.line <= last:
+            caret.column = max(0, caret.column + shifts[caret.line - first])
+            caret.memorize()
+        if first <= caret.sline <= last:
+            caret.scolumn = max(0, caret.scolumn + shifts[caret.sline - first])
+
+    def _offset_index(self):
+        if self._offsets is None:
+            self._flush_active()
+            self._offsets = _LineOffsets(len(line) + 1 for line in self._lines)
+        return self._offsets
+
+    def pos_to_offset(self, line, column):
+        """Returns the absolute character offset of a (line, column)
+        position, newlines counting as a single character.
+
+        The line lengths are kept in a prefix sum index, built on the first
+        call and then updated by each modification, so the conversion costs
+        O(log n) instead of summing the lengths of all the previous lines."""
+        line = max(0, min(len(self) - 1, line))
+        column = max(0, min(self._line_length(line), column))
+        return self._offset_index().prefix(line) + column
+
+    def offset_to_pos(self, offset):
+        """Returns the (line, column) position of an absolute character
+        offset, as computed by pos_to_offset."""
+        index = self._offset_index()
+        if offset <= 0:
+            return 0, 0
+        if offset >= index.total - 1:
+            last = len(self) - 1
+            return last, self._line_length(last)
+        return index.find(offset)
 
     def correct_column(self, line_index):
         """Places the caret column index in a valid position."""
-        self.caret.column = max(0, min(self.caret.memcol, len(self[line_index])))
+        self.caret.column = max(0, min(self.caret.memcol, self._line_length(line_index)))
 
-    def mov_operation(self, op):
-        """Performs text navigation operations.
-        
-        The operations performed in this method does not modify the
-        contents of the text object."""
+    # -- navigation operations --
+
+    def _mov_next_char(self):
         # RIGHT arrow key
-        if op == Caret.MOVNEXTCHAR:
-            if self.caret.column < self.last_column:
-                self.caret.column += 1
-            elif not self.is_last_line:
-                self.caret.line += 1
-                self.caret.column = 0
-            self.caret.memorize()
+        if self.caret.column < self.last_column:
+            self.caret.column += 1
+        elif not self.is_last_line:
+            self.caret.line += 1
+            self.caret.column = 0
+        self.caret.memorize()
 
+    def _mov_prev_char(self):
         # LEFT arrow key
-        elif op == Caret.MOVPREVCHAR:
-            if self.caret.column > 0:
-                self.caret.column -= 1
-            elif not self.is_first_line:
-                self.caret.line -= 1
-                self.caret.column = self.last_column
-            self.caret.memorize()
+        if self.caret.column > 0:
+            self.caret.column -= 1
+        elif not self.is_first_line:
+            self.caret.line -= 1
+            self.caret.column = self.last_column
+        self.caret.memorize()
+
+    def _mov_next_word(self):
+        # CTRL+RIGHT keys
+        text = self.current_line
+        column = self._words.next_word(self.caret.line, text, self.caret.column)
+        if column is not None:
+            self.caret.column = column
+        elif self.caret.column < len(text):
+            self.caret.column = len(text)
+        elif not self.is_last_line:
+            self.caret.line += 1
+            self.caret.column = 0
+        self.caret.memorize()
+
+    def _mov_prev_word(self):
+        # CTRL+LEFT keys
+        column = self._words.prev_word(self.caret.line, self.current_line, self.caret.column)
+        if column is not None:
+            self.caret.column = column
+        elif self.caret.column > 0:
+            self.caret.column = 0
+        elif not self.is_first_line:
+            self.caret.line -= 1
+            self.caret.column = self.last_column
+        self.caret.memorize()
 
+    def _mov_prev_line(self):
         # UP arrow key
-        elif op == Caret.MOVPREVLINE:
-            if not self.is_first_line:
-                self.caret.line -= 1
-                self.correct_column(self.caret.line)
+        if not self.is_first_line:
+            self.caret.line -= 1
+            self.correct_column(self.caret.line)
 
+    def _mov_next_line(self):
         # DOWN arrow key
-        elif op == Caret.MOVNEXTLINE:
-            if not self.is_last_line:
-                self.caret.line += 1
-                self.correct_column(self.caret.line)
+        if not self.is_last_line:
+            self.caret.line += 1
+            self.correct_column(self.caret.line)
 
+    def _mov_down_scroll(self):
         # CTRL + DOWN keys
-        elif op == Caret.MOVDOWNSCROLL:
-            halfpage = self.caret.page_size[1] / 2
-            if self.caret.page_pos[1] < self.last_line - halfpage:
-                self.caret.page_scroll(0, 1)
+        halfpage = self.caret.page_size[1] / 2
+        if self._has_line(self.caret.page_pos[1] + halfpage + 1):
+            self.caret.page_scroll(0, 1)
 
+    def _mov_up_scroll(self):
         # CTRL + UP keys
-        elif op == Caret.MOVUPSCROLL:
-            if self.caret.page_pos[1] > 0:
-                self.caret.page_scroll(0, -1)
+        if self.caret.page_pos[1] > 0:
+            self.caret.page_scroll(0, -1)
 
+    def _mov_text_home(self):
         # CTRL+HOME keys
-        elif op == Caret.MOVTEXTHOME:
-            self.caret.line = 0
-            self.caret.column = 0
-            self.caret.memorize()
-
-        # TODO: add CTRL+LEFT, CTRL+RIGHT commands
+        self.caret.line = 0
+        self.caret.column = 0
+        self.caret.memorize()
 
+    def _mov_text_end(self):
         # CTRL+END keys
-        elif op == Caret.MOVTEXTEND:
-            self.caret.line = len(self) - 1
-            self.caret.column = self.last_column
-            self.caret.memorize()
+        self.caret.line = len(self) - 1
+        self.caret.column = self.last_column
+        self.caret.memorize()
 
+    def _mov_line_home(self):
         # HOME
-        elif op == Caret.MOVLINEHOME:
-            self.caret.column = 0
-            self.caret.memorize()
-
+        # with Caret.WHITESPACEHOME, go to the end of the indentation first
+        column = 0
+        if self.caret.options & Caret.WHITESPACEHOME:
+            indent = self.get_indent_length(self.caret.line)
+            if self.caret.column != indent:
+                column = indent
+        self.caret.column = column
+        self.caret.memorize()
+
+    def _mov_line_end(self):
         # END
-        elif op == Caret.MOVLINEEND:
-            self.caret.column = self.last_column
-            self.caret.memorize()
+        self.caret.column = self.last_column
+        self.caret.memorize()
 
+    def _mov_page_up(self):
         # PAGEUP
-        elif op == Caret.MOVPAGEUP:
-            self.caret.line = self.caret.prev_page_line()
-            self.correct_column(self.caret.line)
+        self.caret.line = self.caret.prev_page_line
+        self.correct_column(self.caret.line)
 
+    def _mov_page_down(self):
         # PAGEDOWN
-        elif op == Caret.MOVPAGEDOWN:
-            jump = self.caret.page_size[1] - 1
-            self.caret.line = min(len(self) - 1, self.caret.line + jump)
-            self.correct_column(self.caret.line)
+        jump = self.caret.page_size[1] - 1
+        self.caret.line = self._bound_line(self.caret.line + jump)
+        self.correct_column(self.caret.line)
 
+    def _mov_page_top(self):
         # CTRL+PAGEUP
-        elif op == Caret.MOVPAGETOP:
-            self.caret.line = self.caret.page_pos[1]
-            self.correct_column(self.caret.line)
+        self.caret.line = self.caret.page_pos[1]
+        self.correct_column(self.caret.line)
 
+    def _mov_page_bottom(self):
         # CTRL+PAGEDOWN
-        elif op == Caret.MOVPAGEBOTTOM:
-            jump = (self.caret.page_pos[1] + self.caret.page_size[1]) - 1
-            self.caret.line = min(len(self) - 1, jump)
-            self.correct_column(self.caret.line)
+        jump = (self.caret.page_pos[1] + self.caret.page_size[1]) - 1
+        self.caret.line = self._bound_line(jump)
+        self.correct_column(self.caret.line)
+
+    _mov_table = {
+        Caret.MOVNEXTCHAR: _mov_next_char,
+        Caret.MOVPREVCHAR: _mov_prev_char,
+        Caret.MOVNEXTWORD: _mov_next_word,
+        Caret.MOVPREVWORD: _mov_prev_word,
+        Caret.MOVPREVLINE: _mov_prev_line,
+        Caret.MOVNEXTLINE: _mov_next_line,
+        Caret.MOVDOWNSCROLL: _mov_down_scroll,
+        Caret.MOVUPSCROLL: _mov_up_scroll,
+        Caret.MOVTEXTHOME: _mov_text_home,
+        Caret.MOVTEXTEND: _mov_text_end,
+        Caret.MOVLINEHOME: _mov_line_home,
+        Caret.MOVLINEEND: _mov_line_end,
+        Caret.MOVPAGEUP: _mov_page_up,
+        Caret.MOVPAGEDOWN: _mov_page_down,
+        Caret.MOVPAGETOP: _mov_page_top,
+        Caret.MOVPAGEBOTTOM: _mov_page_bottom,
+    }
+
+    def mov_operation(self, op):
+        """Performs text navigation operations.
+        
+        The operations performed in this method does not modify the
+        contents of the text object."""
+        handler = self._mov_table.get(op)
+        if handler is not None:
+            self._each_caret(handler)
+            self._check_active()
+
+    # -- selection operations --
+
+    # selection operations and the navigation operation each one performs
+    _sel_table = {
+        Caret.SELPREVCHAR: Caret.MOVPREVCHAR,       # SHIFT+LEFT
+        Caret.SELNEXTCHAR: Caret.MOVNEXTCHAR,       # SHIFT+RIGHT
+        Caret.SELPREVLINE: Caret.MOVPREVLINE,       # SHIFT+UP
+        Caret.SELNEXTLINE: Caret.MOVNEXTLINE,       # SHIFT+DOWN
+        Caret.SELPREVWORD: Caret.MOVPREVWORD,       # CTRL+SHIFT+LEFT
+        Caret.SELNEXTWORD: Caret.MOVNEXTWORD,       # CTRL+SHIFT+RIGHT
+        Caret.SELTEXTHOME: Caret.MOVTEXTHOME,       # CTRL+SHIFT+HOME
+        Caret.SELTEXTEND: Caret.MOVTEXTEND,         # CTRL+SHIFT+END
+        Caret.SELLINEHOME: Caret.MOVLINEHOME,       # SHIFT+HOME
+        Caret.SELLINEEND: Caret.MOVLINEEND,         # SHIFT+END
+        Caret.SELPAGEUP: Caret.MOVPAGEUP,           # SHIFT+PAGEUP
+        Caret.SELPAGEDOWN: Caret.MOVPAGEDOWN,       # SHIFT+PAGEDOWN
+    }
 
     def sel_operation(self, op):
-        """"""
-        # SHIFT+LEFT
-        if op == Caret.SELPREVCHAR:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPREVCHAR)
-
-        # SHIFT+RIGHT
-        elif op == Caret.SELNEXTCHAR:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVNEXTCHAR)
-
-        # SHIFT+UP
-        elif op == Caret.SELPREVLINE:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPREVLINE)
-
-        # SHIFT+DOWN
-        elif op == Caret.SELNEXTLINE:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPREVLINE)
-
-        # CTRL+SHIFT+LEFT
-        elif op == Caret.SELPREVWORD:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPREVWORD)
-
-        # CTRL+SHIFT+RIGHT
-        elif op == Caret.SELNEXTWORD:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVNEXTWORD)
-
-        # CTRL+SHIFT+HOME
-        elif op == Caret.SELTEXTHOME:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVTEXTHOME)
-
-        # CTRL+SHIFT+END
-        elif op == Caret.SELTEXTEND:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVTEXTEND)
-
-        # SHIFT+HOME
-        elif op == Caret.SELLINEHOME:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVLINEHOME)
-
-        # SHIFT+END
-        elif op == Caret.SELLINEEND:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVLINEEND)
-
-        # SHIFT+PAGEUP
-        elif op == Caret.SELPAGEUP:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPAGEUP)
-
-        # SHIFT+PAGEDOWN
-        elif op == Caret.SELPAGEDOWN:
-            self.caret.start_selection()
-            self.mov_operation(Caret.MOVPAGEDOWN)
-
-        elif op == Caret.SELCANCEL:
-            self.caret.selecting = False
+        """Performs text selection operations.
 
-    def mod_operation(self, op, text, pos=None):
-        # Any character typed in insert mode
-        if op == Caret.MODINSERTCHAR:
-            l, r = self.split_line(self.caret.line, self.caret.column)
-            self[self.caret.line] = u'{}{}{}'.format(l, text, r)
-            self.caret.column += 1
-            self.caret.memorize()
+        Each selection operation starts a selection (if none is active)
+        and then moves the caret like its navigation counterpart."""
+        if op == Caret.SELCANCEL:
+            for caret in self.carets:
+                caret.selecting = False
+            return
 
-        # Any character type in overwrite mode
-        elif op == Caret.MODREPLACECHAR:
-            l, r = self.split_line(self.caret.line, self.caret.column)
-            if len(r) in (0, 1):
-                r = ''
-            else:
-                r = r[1:]
-            self[self.caret.line] = u'{}{}{}'.format(l, text, r)
-            self.caret.column += 1
-            self.caret.memorize()
+        handler = self._mov_table.get(self._sel_table.get(op))
+        if handler is not None:
+            self._each_caret(StrList._select, handler)
+            self._check_active()
 
-        # TODO: verify the real utility of Caret.MODINSERTWORD operation in the future.
-        elif op == Caret.MODINSERTWORD:
-            pass
+    def _select(self, handler):
+        self.caret.start_selection()
+        handler(self)
 
-        # CTRL+V (Paste)
-        elif op == Caret.MODINSERTLINE:
-            pass
+    # -- multiple carets --
 
-        # BACKSPACE
-        elif op == Caret.MODERASECHAR:
-            if self.caret.column > 0:
-                l, r = self.split_line(self.caret.line, self.caret.column)
-                if len(l) in (0, 1):
-                    l = ''
+    @property
+    def carets(self):
+        """Gets a list of the carets, the main one ('caret') first."""
+        return [self.caret] + self._carets
+
+    def add_caret(self, line, column):
+        """Adds a caret at the given position and returns it.
+
+        Every operation is performed at each caret, in a single pass over
+        the text from its end to its beginning. Carets that end up at the
+        same position are merged."""
+        caret = Caret(self.caret.indent, self.caret.options)
+        caret.indent_tokens = self.caret.indent_tokens
+        caret.dedent_tokens = self.caret.dedent_tokens
+        caret.page_size = self.caret.page_size
+        caret.line = max(0, min(line, len(self) - 1))
+        caret.column = max(0, min(column, self._line_length(caret.line)))
+        caret.memorize()
+        self._carets.append(caret)
+        return caret
+
+    def remove_caret(self, caret):
+        """Removes a caret added by add_caret()."""
+        self._carets.remove(caret)
+
+    def clear_carets(self):
+        """Removes every caret but the main one."""
+        del self._carets[:]
+
+    def _each_caret(self, handler, *args):
+        """Calls handler(self, *args) with each caret as the current one.
+
+        The carets are visited from the last one in the text to the first,
+        so each edit only moves the carets already visited, which are fixed
+        up as a batch."""
+        if not self._carets:
+            handler(self, *args)
+            return
+
+        def start(caret):
+            if caret.selecting:
+                return min((caret.line, caret.column), (caret.sline, caret.scolumn))
+            return caret.line, caret.column
+
+        main = self.caret
+        fixups = self._fixups = _CaretFixups()
+        try:
+            for caret in sorted(self.carets, key=start, reverse=True):
+                self.caret = caret
+                floor = fixups.floor
+                if floor is not None and start(caret) > floor:
+                    # the text at the caret was replaced by a previous edit
+                    caret.selecting = False
+                    caret.line, caret.column = floor
                 else:
-                    l = l[:-1]
-                self[self.caret.line] = u'{}{}'.format(l, r)
-                self.caret.column -= 1
-
-            elif not self.is_first_line:
-                left = self[self.caret.line - 1]
-                right = self[self.caret.line]
-                self[self.caret.line - 1] = u'{}{}'.format(left, right)
-                del self[self.caret.line]
-                self.caret.line -= 1
-                self.caret.column = len(left)
-
-            self.caret.memorize()
+                    if floor is not None:
+                        # the end of its selection was, at least
+                        if (caret.line, caret.column) > floor:
+                            caret.line, caret.column = floor
+                        if caret.selecting and (caret.sline, caret.scolumn) > floor:
+                            caret.sline, caret.scolumn = floor
+                    handler(self, *args)
+                anchor = caret.selecting and (caret.sline, caret.scolumn) > (caret.line, caret.column)
+                fixups.add(caret, anchor)
+                if caret.selecting:
+                    fixups.add(caret, not anchor)
+        finally:
+            self.caret = main
+            self._fixups = None
+        fixups.apply()
+
+        seen = set([(main.line, main.column)])
+        carets = []
+        for caret in self._carets:
+            position = (caret.line, caret.column)
+            if position not in seen:
+                seen.add(position)
+                carets.append(caret)
+        self._carets[:] = carets
+
+    # -- modification operations --
+
+    def _mod_insert_char(self, text):
+        # Any character typed in insert mode
+        line, column = self.caret.line, self.caret.column
+        self._replace(line, column, line, column, text)
+        self.caret.column += 1
+        self.caret.memorize()
 
+    def _mod_replace_char(self, text):
+        # Any character type in overwrite mode
+        line, column = self.caret.line, self.caret.column
+        self._replace(line, column, line, min(column + 1, self.last_column), text)
+        self.caret.column += 1
+        self.caret.memorize()
+
+    def _mod_insert_word(self, text):
+        # A whole string typed at once (e.g. an input method commit)
+        line, column = self.caret.line, self.caret.column
+        self.caret.line, self.caret.column = self._replace(line, column, line, column, text)
+        self.caret.memorize()
+
+    def _mod_insert_line(self, text):
+        # CTRL+V (Paste)
+        # The text is split into lines once and spliced into the storage by
+        # a single operation, whatever the number of lines it holds.
+        if not isinstance(text, unicode):
+            text = unicode(text)
+        if u'\r' in text:
+            text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+        line, column = self.caret.line, self.caret.column
+        self.caret.line, self.caret.column = self._replace(line, column, line, column, text)
+        self.caret.memorize()
+
+    def _mod_erase_char(self, text):
+        # BACKSPACE
+        line, column = self.caret.line, self.caret.column
+        if column > 0:
+            start = column - 1
+            if self.caret.options & Caret.DEDENTONBKSPC and self.caret.indent > 0:
+                # within the leading spaces, erase back to the previous level
+                if column <= self._leading_spaces(line):
+                    start = start // self.caret.indent * self.caret.indent
+            self._replace(line, start, line, column, u'')
+            self.caret.column = start
+
+        elif not self.is_first_line:
+            prevlen = self._line_length(line - 1)
+            self._replace(line - 1, prevlen, line, 0, u'')
+            self.caret.line -= 1
+            self.caret.column = prevlen
+
+        self.caret.memorize()
+
+    def _mod_erase_word(self, text):
         # CTRL+BACKSPACE
-        elif op == Caret.MODERASEWORD:
-            # Rules:
-            # - erase the closest non-whitespace characters at the left of the caret.
-            # - erase any whitespace character before the non-whitespace ones.
-            # - join the previous line if the beginning of the line is reached before any
-            #   non-whitespace and stop there.
-            whitespaces = u" \n\t"
-            column = self.caret.column
-            endcolumn = column
-            line = self.current_line
-            can_stop = False
-            while column >= 0:
-                if column == 0 and can_stop is False:
-                    # join the previous line
-                    if not self.is_first_line:
-                        left = self[self.caret.line - 1]
-                        right = line[self.caret.column:]
-                        self[self.caret.line - 1] = u'{}{}'.format(left, right)
-
-                        del self[self.caret.line]
-                        self.caret.line -= 1
-                    # erase whatever is on the left side of the caret
-                    else:
-                        self[self.caret.line] = line[self.caret.column:]
-                        self.caret.column = 0
-                        self.caret.memorize()
-                    break
-
-                if line[column] not in whitespaces:
-                    # break the loop at the first whitespace char found or at the line beginning.
-                    can_stop = True
-                else:
-                    if can_stop:
-                        left = line[0: column]
-                        right = line[endcolumn:]
-                        self[self.caret.line] = u'{}{}'.format(left, right)
-                        self.caret.column = len(left)
-                        self.caret.memorize()
-                        break
-                column -= 1
-
-        # TODO: verify the real utility of Caret.MODERASELINE operation in the future.
-        elif op == Caret.MODERASELINE:
-            pass
-
+        # Rules:
+        # - erase the closest word at the left of the caret, along with any
+        #   whitespace between them.
+        # - join the previous line if only whitespace is found before the
+        #   caret and stop there.
+        line, column = self.caret.line, self.caret.column
+        start = self._words.prev_word(line, self.current_line, column)
+        if start is None and not self.is_first_line:
+            prevlen = self._line_length(line - 1)
+            self._replace(line - 1, prevlen, line, column, u'')
+            self.caret.line -= 1
+            self.caret.column = prevlen
+        elif column > 0:
+            start = start or 0
+            self._replace(line, start, line, column, u'')
+            self.caret.column = start
+        self.caret.memorize()
+
+    def _mod_delete_char(self, text):
         # DELETE
-        elif op == Caret.MODDELETECHAR:
-            if self.caret.column < self.last_column:
-                l, r = self.split_line(self.caret.line, self.caret.column)
-                if len(r) in (0, 1):
-                    r = ''
-                else:
-                    r = r[1:]
-                self[self.caret.line] = unicode('{}{}'.format(l, r))
+        line, column = self.caret.line, self.caret.column
+        if column < self.last_column:
+            self._replace(line, column, line, column + 1, u'')
 
-            elif not self.is_last_line:
-                left = self[self.caret.line]
-                right = self[self.caret.line + 1]
-                self[self.caret.line] = unicode('{}{}'.format(left, right))
-                del self[self.caret.line + 1]
+        elif not self.is_last_line:
+            self._replace(line, column, line + 1, 0, u'')
 
-            self.caret.memorize()
+        self.caret.memorize()
 
+    def _mod_delete_word(self, text):
         # CTRL+DELETE
-        elif op == Caret.MODDELETEWORD:
-            # Rules:
-            # - Delete any non-whitespace character at the right until a whitespace character is found.
-            # - or -
-            # - Delete any whitespace character at the right until a non-whitespace character is found.
-            # - if the caret is at the end of line, simply join with the next line (if any).
-            string = self.current_line
-            column = self.caret.column
-            if self.last_column == column:
-                if not self.is_last_line:
-                    left = string
-                    right = self[self.caret.line + 1]
-                    self[self.caret.line] = u"{}{}".format(left, right)
-                    del self[self.caret.line + 1]
-            else:
-                whitespaces = u' \n\t'
-                that = string[column] in whitespaces
-                stop_column = column
-                deleted = False
-                for ch in string[column:]:
-                    this = ch in whitespaces
-                    if this != that:
-                        left = string[:column]
-                        right = string[stop_column:]
-                        self[self.caret.line] = u"{}{}".format(left, right)
-                        deleted = True
-                        break
-                    stop_column += 1
-                if not deleted:
-                    # just remove whatever on the caret's right side
-                    self[self.caret.line] = string[:column]
+        # Rules:
+        # - delete the characters at the right of the caret up to the first
+        #   one of another class (word, punctuation or whitespace).
+        # - if the caret is at the end of line, simply join with the next line (if any).
+        line, column = self.caret.line, self.caret.column
+        string = self.current_line
+        if column >= len(string):
+            if not self.is_last_line:
+                self._replace(line, column, line + 1, 0, u'')
+        else:
+            end = self._words.run_end(line, string, column)
+            self._replace(line, column, line, end, u'')
 
+    def _mod_delete_line(self, text):
         # SHIFT+DELETE
-        elif op == Caret.MODDELETELINE:
-            if not self.is_last_line:
-                del self[self.caret.line]
-                self.correct_column(self.caret.line)
-            else:
-                self[self.caret.line] = ''
-                self.caret.column = 0
-            self.caret.memorize()
+        line = self.caret.line
+        if not self.is_last_line:
+            self._replace(line, 0, line + 1, 0, u'')
+            self.correct_column(line)
+        else:
+            self._replace(line, 0, line, self.last_column, u'')
+            self.caret.column = 0
+        self.caret.memorize()
 
+    def _mod_insert_newline(self, text):
         # RETURN
-        elif op == Caret.MODINSERTNEWLINE:
-            left, right = self.split_line(self.caret.line, self.caret.column)
-            self[self.caret.line] = left
-            self.caret.line += 1
-            if self.is_last_line:
-                self.lines.append(right)
+        line, column = self.caret.line, self.caret.column
+        indent = u''
+        if self.caret.options & Caret.AUTOINDENT:
+            indent = self._newline_indent(line, column)
+        self.caret.line, self.caret.column = self._replace(line, column, line, column, u'\n' + indent)
+        self.caret.memorize()
+
+    def _mod_insert_tab(self, text):
+        # TAB
+        tablen = self.caret.indent - (self.caret.column % self.caret.indent)
+        line, column = self.caret.line, self.caret.column
+        self._replace(line, column, line, column, u' ' * tablen)
+        self.caret.column += tablen
+
+    def _selected_lines(self):
+        """Returns the (first, last) lines of the selection, or the caret's
+        line twice. A line selected up to its first column is left out."""
+        bounds = self._selection_bounds()
+        if bounds is None:
+            return self.caret.line, self.caret.line
+        line, column, end_line, end_column = bounds
+        if end_line > line and end_column == 0:
+            end_line -= 1
+        return line, min(end_line, len(self) - 1)
+
+    def _mod_indent_lines(self, text):
+        # TAB with a selection
+        self.indent_lines(*self._selected_lines())
+
+    def _mod_dedent_lines(self, text):
+        # SHIFT+TAB
+        self.dedent_lines(*self._selected_lines())
+
+    def _mod_delete_selection(self, text):
+        # Deletes the selected text with a single splice, touching only
+        # the first and last selected lines.
+        bounds = self._selection_bounds()
+        if bounds is not None:
+            line, column, end_line, end_column = bounds
+            self._replace(line, column, end_line, end_column, u'')
+            self.caret.line = line
+            self.caret.column = column
+            self.caret.memorize()
+        self.caret.selecting = False
+
+    def _mod_move_selection(self, text, pos=None):
+        # Moves the selected text to 'pos', a (line, column) position taken
+        # before the move. The selected lines are moved by reference.
+        bounds = self._selection_bounds()
+        if bounds is None or pos is None:
+            return
+        line, column, end_line, end_column = bounds
+        # clamped to the text before anything is deleted
+        target = self._clamp(max(0, int(pos[0])), max(0, int(pos[1])))
+        if (line, column) <= target <= (end_line, end_column):
+            return
+
+        if line == end_line:
+            parts = [self[line][column: end_column]]
+        else:
+            parts = [self[line][column:]]
+            parts.extend(self._lines[line + 1: end_line])
+            parts.append(self[end_line][:end_column])
+
+        self._replace(line, column, end_line, end_column, u'')
+        tline, tcolumn = target
+        if target > (end_line, end_column):
+            if tline == end_line:
+                tline, tcolumn = line, column + tcolumn - end_column
             else:
-                self.lines.insert(self.caret.line, right)
-            self.caret.column = 0
+                tline -= end_line - line
+
+        self.caret.sline, self.caret.scolumn = tline, tcolumn
+        self.caret.line, self.caret.column = self._replace_lines(tline, tcolumn, tline, tcolumn, parts)
+        self.caret.selecting = True
+        self.caret.memorize()
+
+    # TODO: verify the real utility of Caret.MODERASELINE operation in the future.
+    _mod_table = {
+        Caret.MODINSERTCHAR: _mod_insert_char,
+        Caret.MODREPLACECHAR: _mod_replace_char,
+        Caret.MODINSERTWORD: _mod_insert_word,
+        Caret.MODINSERTLINE: _mod_insert_line,
+        Caret.MODERASECHAR: _mod_erase_char,
+        Caret.MODERASEWORD: _mod_erase_word,
+        Caret.MODDELETECHAR: _mod_delete_char,
+        Caret.MODDELETEWORD: _mod_delete_word,
+        Caret.MODDELETELINE: _mod_delete_line,
+        Caret.MODINSERTNEWLINE: _mod_insert_newline,
+        Caret.MODINSERTTAB: _mod_insert_tab,
+        Caret.MODDELSELECTION: _mod_delete_selection,
+        Caret.MODMOVSELECTION: _mod_move_selection,
+        Caret.MODINDENTLINES: _mod_indent_lines,
+        Caret.MODDEDENTLINES: _mod_dedent_lines,
+    }
+
+    def mod_operation(self, op, text, pos=None):
+        """Performs text modification operations.
+
+        'pos' is the (line, column) target of Caret.MODMOVSELECTION; the
+        other operations ignore it."""
+        handler = self._mod_table.get(op)
+        if handler is not None and not self.read_only:
+            self._journal.begin(op, self._caret_states())
+            try:
+                if op == Caret.MODMOVSELECTION:
+                    self._each_caret(handler, text, pos)
+                else:
+                    self._each_caret(handler, text)
+            finally:
+                self._journal.end(self._caret_states())
+
+    # -- undo and redo --
+
+    def _caret_states(self):
+        return tuple((caret.line, caret.column, caret.selecting, caret.sline, caret.scolumn)
+                     for caret in self.carets)
+
+    def _record(self, line, column, removed, inserted):
+        """Records an edit in the undo journal, in a group of its own if no
+        operation is in progress."""
+        journal = self._journal
+        if journal.group is not None:
+            journal.record(line, column, removed, inserted)
+        else:
+            journal.begin(None, self._caret_states())
+            journal.record(line, column, removed, inserted)
+            journal.end(None)
+
+    def _restore_carets(self, states):
+        if states is None:
+            return
+        for caret, state in zip(self.carets, states):
+            caret.line, caret.column, caret.selecting, caret.sline, caret.scolumn = state
+            caret.memorize()
+        self._check_active()
+
+    @property
+    def can_undo(self):
+        """Gets whether there are edits to undo."""
+        return bool(self._journal.undos)
+
+    @property
+    def can_redo(self):
+        """Gets whether there are undone edits to redo."""
+        return bool(self._journal.redos)
+
+    def undo(self):
+        """Reverts the last operation (or run of typing) that modified the
+        text. Returns False if there was none."""
+        journal = self._journal
+        if not journal.undos or self.read_only:
+            return False
+        group = journal.undos.pop()
+        journal.size -= group.size
+        journal.replaying = True
+        try:
+            for line, column, removed, inserted in reversed(group.deltas):
+                end_line, end_column = _text_end(line, column, inserted)
+                self._replace(line, column, end_line, end_column, removed)
+        finally:
+            journal.replaying = False
+        journal.redos.append(group)
+        self._restore_carets(group.before)
+        return True
+
+    def redo(self):
+        """Performs again the last operation reverted by undo(). Returns
+        False if there was none."""
+        journal = self._journal
+        if not journal.redos or self.read_only:
+            return False
+        group = journal.redos.pop()
+        journal.replaying = True
+        try:
+            for line, column, removed, inserted in group.deltas:
+                end_line, end_column = _text_end(line, column, removed)
+                self._replace(line, column, end_line, end_column, inserted)
+        finally:
+            journal.replaying = False
+        journal.undos.append(group)
+        journal.size += group.size
+        journal._evict()
+        self._restore_carets(group.after)
+        return True
+
+    def clear_undo(self):
+        """Forgets the edits recorded for undo and redo."""
+        self._journal.clear()
+
+    def set_undo_limits(self, depth=_UNDO_DEPTH, size=_UNDO_SIZE):
+        """Sets the maximum number of operations and of bytes kept for
+        undo; the oldest are dropped first. A depth of 0 disables it."""
+        journal = self._journal
+        journal.depth = depth
+        journal.limit = size
+        if depth <= 0:
+            journal.clear()
+        journal._evict()
+
+    # -- batched operations --
+
+    def _run_ops(self, run, texts):
+        """Performs a coalesced run of (kind, op) operations."""
+        if run[0] != Caret.MODOPERATION:
+            self._each_caret(self._run_table[run], texts)
+            return
+        self._journal.begin(run[1], self._caret_states())
+        try:
+            self._each_caret(self._run_table[run], texts)
+        finally:
+            self._journal.end(self._caret_states())
+
+    def _run_insert_chars(self, texts):
+        self._mod_insert_word(u''.join(texts))
+
+    def _run_erase_chars(self, texts):
+        line, column = self.caret.line, self.caret.column
+        count = min(len(texts), column)
+        if self.caret.options & Caret.DEDENTONBKSPC:
+            # the ones reaching the leading spaces are done one by one
+            count = min(count, max(0, column - self._leading_spaces(line)))
+        if count:
+            self._replace(line, column - count, line, column, u'')
+            self.caret.column -= count
+            self.caret.memorize()
+        for text in texts[count:]:
+            self._mod_erase_char(text)
+
+    def _run_next_chars(self, texts):
+        count = len(texts)
+        line, column = self.caret.line, self.caret.column
+        while count:
+            length = self._line_length(line)
+            if column + count <= length:
+                column += count
+                break
+            if line >= self.last_line:
+                column = max(column, length)
+                break
+            count -= max(0, length - column) + 1
+            line += 1
+            column = 0
+        self.caret.line = line
+        self.caret.column = column
+        self.caret.memorize()
+        self._check_active()
+
+    def _run_prev_chars(self, texts):
+        count = len(texts)
+        line, column = self.caret.line, self.caret.column
+        while count:
+            if count <= column:
+                column -= count
+                break
+            if line == 0:
+                column = 0
+                break
+            count -= column + 1
+            line -= 1
+            column = self._line_length(line)
+        self.caret.line = line
+        self.caret.column = column
+        self.caret.memorize()
+        self._check_active()
+
+    # operations that apply_ops coalesces when they come in a row
+    _run_table = {
+        (Caret.MODOPERATION, Caret.MODINSERTCHAR): _run_insert_chars,
+        (Caret.MODOPERATION, Caret.MODERASECHAR): _run_erase_chars,
+        (Caret.MOVOPERATION, Caret.MOVNEXTCHAR): _run_next_chars,
+        (Caret.MOVOPERATION, Caret.MOVPREVCHAR): _run_prev_chars,
+    }
+
+    def apply_ops(self, ops):
+        """Performs a sequence of (kind, op, text) operations in one call.
+
+        'kind' is Caret.MOVOPERATION, Caret.SELOPERATION or
+        Caret.MODOPERATION and 'text' is ignored by the navigation and
+        selection operations. Runs of MODINSERTCHAR, MODERASECHAR,
+        MOVNEXTCHAR and MOVPREVCHAR are coalesced and performed at once.
+
+        Returns the (first, last) range of lines modified by the whole
+        sequence, or None if the text was not modified."""
+        dispatch = {
+            Caret.MOVOPERATION: self.mov_operation,
+            Caret.SELOPERATION: self.sel_operation,
+            Caret.MODOPERATION: self.mod_operation,
+        }
+        runs = self._run_table
+        if self.read_only:
+            ops = (item for item in ops if item[0] != Caret.MODOPERATION)
+        self._touched = []
+        try:
+            run = None
+            texts = []
+            for kind, op, text in ops:
+                if run is not None:
+                    if (kind, op) == run:
+                        texts.append(text)
+                        continue
+                    self._run_ops(run, texts)
+                    run = None
+
+                if (kind, op) in runs:
+                    run = kind, op
+                    texts = [text]
+                elif kind == Caret.MODOPERATION:
+                    dispatch[kind](op, text)
+                else:
+                    dispatch[kind](op)
+
+            if run is not None:
+                self._run_ops(run, texts)
+
+            return tuple(self._touched) if self._touched else None
+        finally:
+            self._touched = None
+
+    # -- search operations --
+
+    def _search(self, pattern, regex, ignore_case, lines, state=None):
+        """Yields the (line, column, length) matches of a pattern in the
+        given line indexes, recording the matching lines in 'state'."""
+        compiled = _patterns.get(pattern, regex, ignore_case)
+        needle = None if regex or ignore_case else pattern
+        self._flush_active()
+        storage = self._lines
+        for index in lines:
+            text = storage[index]
+            found = False
+            if needle is None or needle in text:
+                for match in compiled.finditer(text):
+                    if not found and state is not None:
+                        # a refining search scans the recorded lines again
+                        # in full, so this one counts as scanned already
+                        state.lines.append(index)
+                        state.scanned = index + 1
+                    found = True
+                    yield index, match.start(), match.end() - match.start()
+            if state is not None:
+                state.scanned = index + 1
+
+    def _search_parallel(self, pattern, regex, ignore_case, first, last,
+                         workers, chunk_size, executor):
+        """Yields the matches of a pattern in the [first, last] line range,
+        scanning chunks of lines in a pool of workers."""
+        if executor is None:
+            executor = _search_pool(workers)
+        pending = deque()
+        try:
+            self._flush_active()
+            for start in xrange(first, last + 1, chunk_size):
+                lines = self._lines[start: min(start + chunk_size, last + 1)]
+                pending.append(executor.submit(
+                    _search_chunk, pattern, regex, ignore_case, start, lines))
+                # keep a bounded number of chunks in flight
+                while len(pending) > 2 * workers:
+                    for match in pending.popleft().result():
+                        yield match
+            while pending:
+                for match in pending.popleft().result():
+                    yield match
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def enable_trigram_index(self):
+        """Builds a trigram index of the lines, kept up to date by each
+        modification from then on.
+
+        Literal searches, and regex searches holding literal runs of three
+        characters or more, then only scan the lines holding all of their
+        trigrams. See trigram_index_memory() for the cost of the index."""
+        if self._trigrams is None:
+            self._flush_active()
+            self._trigrams = _TrigramIndex(self._lines)
+
+    def disable_trigram_index(self):
+        """Drops the trigram index."""
+        self._trigrams = None
+
+    def trigram_index_memory(self):
+        """Returns an estimate of the memory used by the trigram index, in
+        bytes (zero when it is disabled)."""
+        index = self._trigram_index()
+        return index.memory() if index is not None else 0
+
+    def _trigram_index(self):
+        index = self._trigrams
+        if index is not None:
+            self._flush_active()
+            if index.stale:
+                index.rebuild(self._lines)
+        return index
+
+    def _candidate_lines(self, pattern, regex, first, last):
+        """Returns the indexes of the lines in the [first, last] range that
+        may match a pattern, or None if they all have to be scanned."""
+        index = self._trigram_index()
+        if index is None:
+            return None
+        lines = index.candidates(pattern, regex)
+        if lines is None:
+            return None
+        return lines[bisect_left(lines, first): bisect_right(lines, last)]
+
+    def find_all(self, pattern, regex=False, ignore_case=False, first_line=0, last_line=None,
+                 workers=None, chunk_size=_PARALLEL_CHUNK_SIZE, executor=None):
+        """Yields the (line, column, length) position of each match of
+        'pattern' in the text, in document order.
+
+        'pattern' is a literal string, or a regular expression if 'regex'
+        is true; matches do not span several lines. Compiled patterns are
+        kept in a LRU cache, and since the results are generated as the
+        text is scanned, the first ones come right away even on huge
+        texts.
+
+        When the trigram index is enabled, only the lines it finds as
+        candidates are scanned. Otherwise, with more than one worker, or a
+        concurrent.futures 'executor' to run on (which is left running),
+        chunks of 'chunk_size' lines are scanned in parallel and their
+        results merged in document order. Without an executor, a process
+        pool of 'workers' workers is started on first use and shared by
+        the following searches. Without concurrent.futures, or when the
+        lines to scan would fill less than two chunks, the text is scanned
+        in this process."""
+        last_line = len(self) - 1 if last_line is None else min(last_line, len(self) - 1)
+        candidates = self._candidate_lines(pattern, regex, first_line, last_line)
+        if candidates is not None:
+            return self._search(pattern, regex, ignore_case, candidates)
+
+        parallel = executor is not None or (workers or 1) > 1
+        if parallel and futures is not None and last_line - first_line + 1 >= 2 * chunk_size:
+            workers = workers or cpu_count()
+            return self._search_parallel(pattern, regex, ignore_case, first_line, last_line,
+                                         workers, chunk_size, executor)
+        return self._search(pattern, regex, ignore_case, xrange(first_line, last_line + 1))
+
+    def find(self, pattern, regex=False, ignore_case=False, start=None, wrap=True):
+        """Returns the (line, column, length) position of the first match of
+        'pattern' at or after 'start' (the caret position by default),
+        wrapping around the end of the text if 'wrap' is true, or None."""
+        line, column = start if start is not None else (self.caret.line, self.caret.column)
+        for match in self.find_all(pattern, regex, ignore_case, line):
+            if match[0] > line or match[1] >= column:
+                return match
+        if wrap:
+            for match in self.find_all(pattern, regex, ignore_case, 0, line):
+                return match
+
+    def find_incremental(self, pattern, ignore_case=False):
+        """Yields the matches of a literal pattern, for search as you type.
+
+        When the text did not change and 'pattern' extends the pattern of
+        the previous call (e.g. one more character was typed), only the
+        lines matched by the previous call are scanned again, plus the ones
+        it did not get to scan if its results were not fully consumed."""
+        previous = self._search_state
+        state = _SearchState(self._version, pattern, ignore_case)
+        self._search_state = state
+        if previous is not None and previous.refines(self._version, pattern, ignore_case):
+            lines = chain(list(previous.lines), xrange(previous.scanned, len(self)))
+        else:
+            lines = self._candidate_lines(pattern, False, 0, len(self) - 1)
+            if lines is None:
+                lines = xrange(len(self))
+        return self._search(pattern, False, ignore_case, lines, state)
+
+    def replace_all(self, pattern, replacement, regex=False, ignore_case=False):
+        """Replaces every match of 'pattern' with 'replacement', which may
+        hold group references in regex mode.
+
+        Only the lines holding matches are rebuilt. Returns the number of
+        replacements made."""
+        compiled = _patterns.get(pattern, regex, ignore_case)
+        if not regex:
+            template = replacement
+            replacement = lambda match: template
+
+        changes = []
+        count = 0
+        for line, column, length in self.find_all(pattern, regex, ignore_case):
+            if changes and changes[-1][0] == line:
+                continue
+            text, num = compiled.subn(replacement, self._lines[line])
+            changes.append((line, text))
+            count += num
+
+        # from the bottom up, as replacements may hold newlines
+        self._journal.begin(None, self._caret_states())
+        try:
+            for line, text in reversed(changes):
+                self._replace_lines(line, 0, line, self._line_length(line), text.split(u'\n'))
+        finally:
+            self._journal.end(self._caret_states())
+        return count
+
+    def find_next(self, pattern, regex=False, ignore_case=False):
+        """Selects the next match of 'pattern' after the caret and returns
+        its (line, column, length) position, or None."""
+        start = (self.caret.line, self.caret.column)
+        if self.has_selection:
+            start = max(start, (self.caret.sline, self.caret.scolumn))
+        match = self.find(pattern, regex, ignore_case, start)
+        if match is not None:
+            line, column, length = match
+            self.caret.sline, self.caret.scolumn = line, column
+            self.caret.selecting = True
+            self.caret.line = line
+            self.caret.column = column + length
             self.caret.memorize()
+            self._check_active()
+        return match
+
+    _utl_table = {
+        Caret.UTLGETSELECTION: get_selection,
+        Caret.UTLFINDNEXT: find_next,
+        Caret.UTLREPLACEALL: replace_all,
+    }
+
+    def utl_operation(self, op, *args, **kwargs):
+        """Performs utility text operations.
+
+        UTLGETSELECTION takes no arguments, UTLFINDNEXT takes the arguments
+        of find_next() and UTLREPLACEALL the ones of replace_all()."""
+        handler = self._utl_table.get(op)
+        if handler is not None:
+            return handler(self, *args, **kwargs)
+
+    # -- advanced operations --
+
+    def load(self, source, encoding=None):
+        """Loads the text from a file, replacing the current one.
+
+        'source' is a file name or a binary file object, which is read in
+        chunks and decoded incrementally, so no copy of the whole file is
+        kept besides the lines themselves. When 'encoding' is None it is
+        detected from the byte order mark, defaulting to UTF-8 and falling
+        back to Latin-1 for files that are not valid UTF-8. The encoding
+        and the line terminator (LF or CRLF) found in the file are kept in
+        the 'encoding' and 'newline' attributes, to be used by save()."""
+        if isinstance(source, basestring):
+            with io.open(source, 'rb') as stream:
+                return self.load(stream, encoding)
+
+        start = _stream_start(source)
+        sample = source.read(_IO_CHUNK_SIZE)
+        detected = encoding is None
+        if detected:
+            encoding = _detect_encoding(sample)
+
+        try:
+            lines, newline = _decode_lines(source, sample, encoding)
+        except UnicodeDecodeError:
+            if not detected or start is None:
+                raise
+            source.seek(start)
+            encoding = 'latin-1'
+            lines, newline = _decode_lines(source, source.read(_IO_CHUNK_SIZE), encoding)
+
+        self.encoding = encoding
+        self.newline = newline or self.newline
+        self._set_lines(lines)
+
+    def save(self, target, encoding=None, newline=None):
+        """Saves the text to a file.
+
+        'target' is a file name or a binary file object. The lines are
+        encoded and written in chunks, without building the whole text in
+        memory.
+        'encoding' and 'newline' default to the ones of the loaded file."""
+        _save_lines(self, target, encoding or self.encoding, newline or self.newline)
+
+    def to_text(self, newline=None):
+        """Returns the whole text as a single string."""
+        return (newline or self.newline).join(self)
+
+    def from_text(self, text):
+        """Replaces the whole text with 'text', detecting its line terminator."""
+        if not isinstance(text, unicode):
+            text = unicode(text)
+        newline = u'\r\n' if u'\r\n' in text else u'\n'
+        if newline != u'\n':
+            text = text.replace(newline, u'\n')
+        self.newline = newline
+        self._set_lines(text.split(u'\n'))
+
+    def open_mapped(self, path, encoding=None):
+        """Opens a file for read-only viewing, replacing the current text.
+
+        The file is memory-mapped through a MappedLines storage, so its
+        lines are only indexed and decoded as they are accessed. All the
+        navigation and selection operations work as usual, while the
+        modification operations are ignored."""
+        self.lines = MappedLines(path, encoding)
+        self.encoding = self._lines.encoding
+        self.newline = self._lines.newline
+        self._reset_caret()
 
-        # TAB
-        elif op == Caret.MODINSERTTAB:
-            tablen = self.caret.indent - (self.caret.column % self.caret.indent)
-            line = self[self.caret.line]
-            column = self.caret.column
-            tab = u' ' * tablen
-            left = line[:column]
-            right = line[column:]
-            self[self.caret.line] = u'{}{}{}'.format(left, tab, right)
-            self.caret.column += tablen
-
-        elif op == Caret.MODDELSELECTION:
-            pass
-        elif op == Caret.MODMOVSELECTION:
-            pass
+    @property
+    def read_only(self):
+        """Gets whether the storage can not be modified."""
+        return getattr(self._lines, 'read_only', False)
+
+    def start_journal(self, path, journal_path=None, sync_delay=_JOURNAL_SYNC_DELAY,
+                      compact_size=_JOURNAL_COMPACT_SIZE):
+        """Starts journaling the edits for crash-safe autosave.
+
+        The text is loaded from the file at 'path', if it exists, and the
+        edits left in the journal at 'journal_path' ('path' + '.journal' by
+        default) are replayed over it, up to the last one fully written.
+        Every further edit is appended to the journal, which is synced to
+        disk in batches by a background thread, 'sync_delay' seconds apart.
+        Once the journal grows past 'compact_size' bytes, it is compacted:
+        the text is written to 'path' and the journal starts anew.
+
+        An edit inserting characters that the encoding of the file can not
+        hold raises UnicodeEncodeError and leaves the text unchanged. An
+        error of the background thread is raised by every further edit and
+        journal call, stop_journal() included, which ends the journal."""
+        self.stop_journal()
+        journal_path = journal_path or path + '.journal'
+        digest = None
+        append = False
+        if os.path.exists(path):
+            self.load(path)
+            digest = _file_digest(path)
+            if os.path.exists(journal_path):
+                append = self._replay_journal(journal_path, digest)
+                self._journal.clear()
+        elif not len(self):
+            self._set_lines([u''])
+
+        wal = _EditJournal(path, journal_path, self.encoding, self.newline,
+                           sync_delay, compact_size)
+        wal.start(list(self), digest, append)
+        self._wal = wal
+
+    def _replay_journal(self, journal_path, digest):
+        """Applies the edits in a journal, dropping a partly written one
+        at its end. Returns False if the journal does not apply to the
+        base file whose (size, CRC-32) is 'digest'."""
+        with io.open(journal_path, 'r+b') as stream:
+            try:
+                header = json.loads(stream.readline())
+            except ValueError:
+                return False
+            if header != {'size': digest[0], 'crc': digest[1]}:
+                return False
+
+            end = stream.tell()
+            for record in iter(stream.readline, b''):
+                if not record.endswith(b'\n'):
+                    break
+                try:
+                    line, column, end_line, end_column, text = json.loads(record)
+                    self._replace(line, column, end_line, end_column, text)
+                except (ValueError, TypeError, IndexError):
+                    break
+                end = stream.tell()
+            stream.seek(end)
+            stream.truncate()
+        return True
+
+    def sync_journal(self):
+        """Waits until every edit made so far is journaled on disk."""
+        if self._wal is not None:
+            self._check_journal()
+            self._wal.sync()
+
+    def compact_journal(self):
+        """Writes the text to the base file of the journal, which then
+        starts anew. The file is written by the background thread, from a
+        snapshot of the text taken right away."""
+        if self._wal is not None:
+            self._wal.compact(self.snapshot())
+
+    def stop_journal(self):
+        """Syncs the journal and stops journaling the edits."""
+        wal = self._wal
+        if wal is not None:
+            self._check_journal()
+            self._wal = None
+            wal.close()
+
+    def _check_journal(self):
+        """Compacts the journal if the text was modified behind it, or if
+        it grew too large."""
+        wal = self._wal
+        if wal.stale or wal.size >= wal.compact_size:
+            wal.compact(self.snapshot())
+
+    def _log(self, line, column, end_line, end_column, text):
+        """Appends an edit about to be made to the journal."""
+        self._check_journal()
+        self._wal.append(line, column, end_line, end_column, text)
+
+    def _set_lines(self, lines):
+        """Replaces all the lines and resets the caret."""
+        if self.read_only:
+            self.lines = []
+        self._active = None
+        self._active_dirty = False
+        self._splice_lines(0, len(self), lines)
+        self._journal.clear()
+        if self._wal is not None:
+            self._wal.stale = True
+        self._reset_caret()
+
+    def _reset_caret(self):
+        self.caret.selecting = False
+        self.caret.page_pos = (0, 0)
+        self.caret.line = 0
+        self.caret.column = 0
+        self.caret.memorize()
+
+    _adv_table = {
+        Caret.ADVSAVETOFILE: save,
+        Caret.ADVSAVETOMEM: to_text,
+        Caret.ADVOPENFROMFILE: load,
+        Caret.ADVOPENFROMMEM: from_text,
+    }
+
+    def adv_operation(self, op, *args, **kwargs):
+        """Performs advanced text operations.
+
+        ADVSAVETOFILE and ADVOPENFROMFILE take a file name or a binary
+        file object; ADVSAVETOMEM returns the text as a string and
+        ADVOPENFROMMEM takes the text as a string."""
+        handler = self._adv_table.get(op)
+        if handler is not None:
+            return handler(self, *args, **kwargs)
+
+    def _splice_lines(self, start, stop, lines):
+        """Replaces the lines in the [start, stop) range with 'lines'.
+
+        Every modification of the text ends up here, or in the active line
+        buffer. Callers must write back the active line buffer first."""
+        self._store_lines(start, stop, lines)
+        self._version += 1
+        if self._offsets is not None:
+            self._offsets.splice(start, stop, [len(line) + 1 for line in lines])
+        self._line_changed(start, stop, len(lines))
+
+    def _store_lines(self, start, stop, lines):
+        """Writes lines to the storage, keeping the indexes that depend on
+        their contents up to date."""
+        if self._trigrams is not None and not self._trigrams.stale:
+            self._trigrams.splice(start, stop, self._lines[start: stop], lines)
+        if self._mirror is not None:
+            self._mirror[start: stop] = lines
+        self._lines[start: stop] = lines
+
+    def _line_changed(self, start, stop, count):
+        """Records and notifies that the lines in the [start, stop) range
+        were replaced with 'count' lines."""
+        self._changes._splice(start, stop, count)
+        if self._indents is not None:
+            self._indents[start: stop] = [None] * count
+        for listener in self._listeners:
+            listener(start, stop, count)
+
+    def _line_length(self, index):
+        """Returns the length of a line without materializing it."""
+        if self._active is not None and index == self._active_line:
+            return len(self._active)
+        return len(self._lines[index])
+
+    def _activate(self, index):
+        """Returns the gap buffer for the line at 'index', writing back the
+        buffer of any other line."""
+        if self._active is not None:
+            if self._active_line == index:
+                return self._active
+            self._release_active()
+        self._active = _GapBuffer(self._lines[index])
+        self._active_line = index
+        return self._active
+
+    def _flush_active(self):
+        """Writes the active line buffer to the storage, keeping the buffer
+        for further edits."""
+        if self._active_dirty:
+            self._active_dirty = False
+            # the edits were already recorded as they were made
+            self._store_lines(self._active_line, self._active_line + 1, [self._active.text()])
+
+    def _release_active(self):
+        """Writes the active line buffer to the storage and drops it."""
+        if self._active is not None:
+            self._flush_active()
+            self._active = None
+
+    def _check_active(self):
+        """Releases the active line buffer if the caret left its line."""
+        if self._active is not None and self._active_line != self.caret.line:
+            self._release_active()
+
+    def _note_change(self, line, column, end_line, end_column, new_end_line, new_end_column):
+        """Records that the text from (line, column) to (end_line, end_column)
+        was replaced by text ending at (new_end_line, new_end_column).
+
+        Extends the range of lines touched by apply_ops and moves the
+        carets already visited by a multiple caret operation."""
+        if self._fixups is not None:
+            self._fixups.edit(line, column, end_line, end_column, new_end_line, new_end_column)
+        touched = self._touched
+        if touched is None:
+            return
+        if touched:
+            first, last = touched
+            touched[0] = min(first, line)
+            touched[1] = last + new_end_line - end_line if last > end_line else new_end_line
+        else:
+            touched[:] = [line, new_end_line]
+
+    def _replace(self, line, column, end_line, end_column, text):
+        """Replaces the text between (line, column) and (end_line, end_column)
+        with 'text', which may contain newlines.
+
+        However many lines are joined or split, the storage is modified
+        by a single splice. Returns the (line, column) position right after
+        the inserted text."""
+        if not isinstance(text, unicode):
+            text = unicode(text)
+
+        if line == end_line and u'\n' not in text:
+            buf = self._activate(line)
+            column = min(column, len(buf))
+            if self._wal is not None:
+                self._log(line, column, line, end_column, text)
+            if self._journal.recording:
+                removed = buf.slice(column, end_column) if end_column > column else u''
+                self._record(line, column, removed, text)
+            buf.replace(column, end_column, text)
+            self._active_dirty = True
+            self._version += 1
+            if self._offsets is not None:
+                self._offsets.set(line, len(buf) + 1)
+            self._line_changed(line, line + 1, 1)
+            self._note_change(line, column, line, end_column, line, column + len(text))
+            return line, column + len(text)
+
+        return self._replace_lines(line, column, end_line, end_column, text.split(u'\n'))
+
+    def _replace_lines(self, line, column, end_line, end_column, parts):
+        """Like _replace, but takes the new text already split into a list
+        of lines, which is spliced into the storage as is."""
+        self._release_active()
+        first = self._lines[line]
+        last = first if end_line == line else self._lines[end_line]
+        column = min(column, len(first))
+        if self._wal is not None:
+            self._log(line, column, end_line, end_column, u'\n'.join(parts))
+        if self._journal.recording:
+            if end_line == line:
+                removed = first[column: end_column]
+            else:
+                middle = self._lines[line + 1: end_line]
+                removed = u'\n'.join(chain([first[column:]], middle, [last[:end_column]]))
+            self._record(line, column, removed, u'\n'.join(parts))
+
+        if len(parts) == 1:
+            endcolumn = column + len(parts[0])
+            parts[0] = first[:column] + parts[0] + last[end_column:]
+        else:
+            endcolumn = len(parts[-1])
+            parts[0] = first[:column] + parts[0]
+            parts[-1] += last[end_column:]
+        self._splice_lines(line, end_line + 1, parts)
+        self._note_change(line, column, end_line, end_column, line + len(parts) - 1, endcolumn)
+        return line + len(parts) - 1, endcolumn
 
     def split_line(self, line, col):
-        ln = self.lines[line]
+        ln = self[line]
         if 0 < col < len(ln):
             left = ln[:col]
             right = ln[col:]
@@ -679,3 +3618,34 @@ class StrList(object):
             right = ''
 
         return left, right
+
+
+class InputCoalescer(object):
+
+    """Gathers typed characters and inserts them into a StrList at once.
+
+    Characters fed between two calls of flush() (e.g. the ones arriving
+    within a single frame of an event loop) are inserted by a single
+    Caret.MODINSERTWORD operation instead of one MODINSERTCHAR each.
+    Any other operation on the StrList must be preceded by a flush().
+    """
+
+    __slots__ = ('strlist', '_pending')
+
+    def __init__(self, strlist):
+        self.strlist = strlist
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def feed(self, text):
+        """Queues text to be inserted at the caret."""
+        self._pending.append(text)
+
+    def flush(self):
+        """Inserts the queued text, if any."""
+        if self._pending:
+            text = u''.join(self._pending)
+            del self._pending[:]
+            self.strlist.mod_operation(Caret.MODINSERTWORD, text)
@@ -9,6 +9,7 @@ __all__ = [
 
 import os
 import pygame
+from collections import OrderedDict
 from __init__ import *
 import pygame.locals as c
 
@@ -28,35 +29,115 @@ def blend_color(a, b, r):
 
 class BmpFont(object):
 
-    image = pygame.image.load(os.path.join(os.getcwd(), "res/CBFG_Consolas_24x16_cp1252.png"))
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "res", "CBFG_Consolas_24x16_cp1252.png")
+    source_image = None
+    image = None
     glyph_size = (16, 24)
     glyphs = u" !\"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~_¡¢£¤¥¦§¨©ª«¬­®¯°±²³´µ¶·¸¹º»¼½¾¿ÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖ×ØÙÚÛÜÝÞßàáâãäåæçèéêëìíîïðñòóôõö÷øùúûüýþÿ"
-    def_palette = image.get_palette()
-    nrm_palette = [normalize_color(color) for color in def_palette]
+    def_palette = None
+    nrm_palette = None
     advance = 10
+    colors = None
+    texglyphs = None
+    line_cache = OrderedDict()
+    line_cache_size = 256
+    atlas_cache = OrderedDict()
+    atlas_cache_size = 8
+
+    @classmethod
+    def load(cls):
+        """Loads the font image and its palette; called on first use."""
+        cls.source_image = pygame.image.load(cls.path)
+        cls.def_palette = cls.source_image.get_palette()
+        cls.nrm_palette = [normalize_color(color) for color in cls.def_palette]
+        if cls.image is None:
+            cls.image = cls.source_image
+
+    @classmethod
+    def get_atlas(cls, forecolor, backcolor):
+        """Returns a copy of the font image tinted with the given colors.
+
+        The copies are cached by colors, up to atlas_cache_size of them."""
+        key = (tuple(forecolor), tuple(backcolor))
+        atlas = cls.atlas_cache.pop(key, None)
+        if atlas is None:
+            if cls.source_image is None:
+                cls.load()
+            atlas = cls.source_image.copy()
+            atlas.set_palette([blend_color(backcolor, forecolor, ratio) for ratio in cls.nrm_palette])
+            if pygame.display.get_surface() is not None:
+                # blits are faster in the format of the display
+                atlas = atlas.convert()
+            if len(cls.atlas_cache) >= cls.atlas_cache_size:
+                cls.atlas_cache.popitem(last=False)
+        cls.atlas_cache[key] = atlas
+        return atlas
 
     @classmethod
     def set_colors(cls, forecolor, backcolor):
-        for index in range(256):
-            ratio = cls.nrm_palette[index]
-            cls.image.set_palette_at(index, blend_color(backcolor, forecolor, ratio))
+        cls.colors = (tuple(forecolor), tuple(backcolor))
+        cls.image = cls.get_atlas(forecolor, backcolor)
+
+    @classmethod
+    def _load_texglyphs(cls):
+        """Builds the table mapping each glyph to its rect in the image.
+
+        The table only depends on the glyph layout, so the image itself is
+        not loaded."""
+        width, height = cls.glyph_size
+        texglyphs = {}
+        for index, glyph in enumerate(cls.glyphs):
+            gy, gx = divmod(index, 32)
+            texglyphs.setdefault(glyph, (gx * width, gy * height, cls.advance, height))
+        cls.texglyphs = texglyphs
 
     @classmethod
     def get_texglyph(cls, glyph):
-        if glyph not in cls.glyphs:
+        if cls.texglyphs is None:
+            cls._load_texglyphs()
+        texglyph = cls.texglyphs.get(glyph)
+        if texglyph is None:
             return (0, 0) + (cls.advance, cls.glyph_size[1])
+        return texglyph
 
-        gy, gx = divmod(cls.glyphs.index(glyph), 32)
+    @classmethod
+    def has_glyph(cls, glyph):
+        """Gets whether the font can draw a glyph."""
+        if cls.texglyphs is None:
+            cls._load_texglyphs()
+        return glyph in cls.texglyphs
 
-        return (gx * cls.glyph_size[0], gy * cls.glyph_size[1], cls.advance, cls.glyph_size[1])
+    @classmethod
+    def text_size(cls, text):
+        """Gets the size in pixels of a line of text, without loading the font."""
+        return (len(text) * cls.advance, cls.glyph_size[1])
 
     @classmethod
-    def render(cls, surface, text, position):
-        x, y = position
+    def render_line(cls, text):
+        """Returns a new surface with the text drawn in the current colors."""
+        if cls.image is None:
+            cls.load()
+        line = pygame.Surface(cls.text_size(text))
+        x = 0
         for ch in text:
-            rct = cls.get_texglyph(ch)
-            surface.blit(cls.image, (x, y), rct)
+            line.blit(cls.image, (x, 0), cls.get_texglyph(ch))
             x += cls.advance
+        return line
+
+    @classmethod
+    def render(cls, surface, text, position):
+        if not text:
+            return
+
+        # recently drawn lines are kept as surfaces; one blit each
+        key = (text, cls.colors)
+        line = cls.line_cache.pop(key, None)
+        if line is None:
+            line = cls.render_line(text)
+            if len(cls.line_cache) >= cls.line_cache_size:
+                cls.line_cache.popitem(last=False)
+        cls.line_cache[key] = line
+        surface.blit(line, position)
 
 
 class TextBox(StrList):
@@ -70,6 +151,11 @@ class TextBox(StrList):
         self._position = position
         self.caret.page_size = page_size
 
+        # offscreen copy of the visible lines, redrawn only where needed
+        self._page = None
+        self._page_key = None
+        self._page_top = 0
+
     @property
     def position(self):
         return self._position[:]
@@ -78,6 +164,62 @@ class TextBox(StrList):
     def position(self, value):
         self.position = value[0], value[1]
 
+    def _draw_lines(self, first, last):
+        """Redraws the rows of the cached page showing lines first to last."""
+        top = self._page_top
+        rows = self.caret.page_size[1]
+        first = max(first, top)
+        last = min(last, top + rows)
+        if first >= last:
+            return
+
+        height = BmpFont.glyph_size[1]
+        firstcolumn = self.caret.page_pos[0]
+        lastcolumn = firstcolumn + self.caret.page_size[0]
+        backcolor = self._page_key[-1]
+
+        self._page.fill(backcolor, (0, (first - top) * height, self._page.get_width(), (last - first) * height))
+        for index in xrange(first, last):
+            if not self._has_line(index):
+                break
+            BmpFont.render(self._page, self[index][firstcolumn: lastcolumn], (0, (index - top) * height))
+
+    def _update_page(self, backcolor):
+        """Brings the cached page up to date, drawing only what changed."""
+        changes = self.changes()
+        top, rows = self.caret.page_pos[1], self.caret.page_size[1]
+        width = self.caret.page_size[0] * BmpFont.advance
+        height = rows * BmpFont.glyph_size[1]
+        key = (width, height, self.caret.page_pos[0], BmpFont.colors, backcolor)
+
+        if self._page is None or key != self._page_key:
+            # anything but the vertical position changed; redraw it all
+            if self._page is None or self._page.get_size() != (width, height):
+                self._page = pygame.Surface((width, height))
+            self._page_key = key
+            self._page_top = top
+            self._draw_lines(top, top + rows)
+            return
+
+        delta = top - self._page_top
+        if delta:
+            self._page_top = top
+            if abs(delta) < rows:
+                # shift what is still visible; draw the exposed lines only
+                self._page.scroll(0, -delta * BmpFont.glyph_size[1])
+                if delta > 0:
+                    self._draw_lines(top + rows - delta, top + rows)
+                else:
+                    self._draw_lines(top, top - delta)
+            else:
+                self._draw_lines(top, top + rows)
+
+        if changes.shifted is not None:
+            self._draw_lines(changes.shifted, top + rows)
+        for index in changes.lines:
+            if top <= index < top + rows:
+                self._draw_lines(index, index + 1)
+
     def render(self, surface, backcolor=(0, 0, 0)):
 
         left = self.position[0] - 1
@@ -88,19 +230,16 @@ class TextBox(StrList):
         pts = [(left, top), (left + width, top), (left + width, top + height), (left, top + height)]
         pygame.draw.polygon(surface, backcolor, pts)
 
+        self._update_page(backcolor)
+        surface.blit(self._page, self.position)
+
         firstline = self.caret.page_pos[1]
-        lastline = min(len(self), firstline + self.caret.page_size[1])
         firstcolumn = self.caret.page_pos[0]
 
         x, y = self.position
         caretline = y + ((self.caret.line - firstline) * BmpFont.glyph_size[1])
         caretcolumn = x + ((self.caret.column - firstcolumn) * BmpFont.advance)
 
-        for index, line in enumerate(self[firstline: lastline + 1]):
-            lastcolumn = min(len(line), firstcolumn + self.caret.page_size[0])
-            BmpFont.render(surface, line[firstcolumn: lastcolumn], (x, y))
-            y += BmpFont.glyph_size[1]
-
         pygame.draw.line(
             surface,
             (255, 0, 0),
@@ -138,6 +277,7 @@ def program():
         u"or the end of the current line."
     ]
 
+    typed = InputCoalescer(textbox)
     done = False
 
     while not done:
@@ -146,6 +286,10 @@ def program():
                 done = True
 
             elif event.type == c.KEYDOWN:
+                if not event.unicode or not BmpFont.has_glyph(event.unicode):
+                    # keep the typed text in order with the other commands
+                    typed.flush()
+
                 ctrl  = event.mod & c.KMOD_LCTRL or event.mod & c.KMOD_RCTRL
                 shift = event.mod & c.KMOD_LSHIFT or event.mod & c.KMOD_RSHIFT
                 alt   = event.mod & c.KMOD_LALT or event.mod & c.KMOD_RALT
@@ -172,7 +316,17 @@ def program():
                         textbox.mod_operation(Caret.MODERASEWORD, None)
 
                 elif event.key == c.K_RETURN:
-                    pass
+                    textbox.mod_operation(Caret.MODINSERTNEWLINE, None)
+
+                elif event.key == c.K_TAB:
+                    if shift_only:
+                        textbox.mod_operation(Caret.MODDEDENTLINES, None)
+
+                    elif textbox.has_selection:
+                        textbox.mod_operation(Caret.MODINDENTLINES, None)
+
+                    elif none:
+                        textbox.mod_operation(Caret.MODINSERTTAB, None)
 
                 elif event.key == c.K_UP:
                     if none:
@@ -195,9 +349,19 @@ def program():
                         textbox.sel_operation(Caret.SELNEXTLINE)
 
                 elif event.key == c.K_RIGHT:
-                    textbox.mov_operation(Caret.MOVNEXTCHAR)
+                    if ctrl_only:
+                        textbox.mov_operation(Caret.MOVNEXTWORD)
+                    elif ctrl and shift:
+                        textbox.sel_operation(Caret.SELNEXTWORD)
+                    else:
+                        textbox.mov_operation(Caret.MOVNEXTCHAR)
                 elif event.key == c.K_LEFT:
-                    textbox.mov_operation(Caret.MOVPREVCHAR)
+                    if ctrl_only:
+                        textbox.mov_operation(Caret.MOVPREVWORD)
+                    elif ctrl and shift:
+                        textbox.sel_operation(Caret.SELPREVWORD)
+                    else:
+                        textbox.mov_operation(Caret.MOVPREVCHAR)
 
                 elif event.key == c.K_PAGEUP:
                     if none:
@@ -234,10 +398,16 @@ def program():
                     pass
                 else:
                     if none or shift_only:
-                        if event.unicode in BmpFont.glyphs and event.unicode != '':
-                            textbox.mod_operation(Caret.MODINSERTCHAR, event.unicode)
+                        if event.unicode and BmpFont.has_glyph(event.unicode):
+                            typed.feed(event.unicode)
 
                     elif ctrl_only:
+                        if event.key == c.K_z:
+                            textbox.undo()
+
+                        elif event.key == c.K_y:
+                            textbox.redo()
+
                         if event.key == c.K_x:
                             # Cut command goes here...
                             pass
@@ -251,6 +421,9 @@ def program():
                             pass
 
 
+        # everything typed during this frame is inserted at once
+        typed.flush()
+
         clock.tick(30)
         surface.fill((192, 192, 192))
 